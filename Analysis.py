@@ -1,383 +1,512 @@
 import pandas as pd
 import numpy as np
-import operator
 from functools import reduce
 import collections
 import sys
-import math
+import glob
+import os
+import urllib.parse
 
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table_experiments as dt
 import plotly.graph_objs as go
+from dash.dependencies import Input, Output
+import cache
+import cohort_query
 import methods
+import metric_state
+import metric_store
+import order_store
+import periods
+import pipeline
+import profiling
+
+EXPORT_PATTERN = 'query_result_*.csv'
+
+# columns the orders can be filtered on
+SEGMENT_COLUMNS = ['store_id','channel','currency']
+
+# days give hundreds of periods, too many for the cohort tables
+DASHBOARD_GRANULARITIES = ['Month','Week','Quarter']
+
+# built layouts, one per version of the exports
+layout_cache = cache.TTLCache(maxsize=4,ttl=60*60)
+
+# completed orders of the latest version of the exports
+orders_cache = cache.TTLCache(maxsize=1,ttl=60*60)
+
+# metrics of the most recently used filter combinations
+metrics_cache = cache.TTLCache(maxsize=32,ttl=60*60)
+
+# cohort membership index of the latest version of the exports
+index_cache = cache.TTLCache(maxsize=1,ttl=60*60)
+
+# styled rows of the most recently shown table pages
+pages_cache = cache.TTLCache(maxsize=256,ttl=60*60)
+
+# precomputed metrics shared by the server workers, written by metric_store.py
+METRIC_STORE_DIR = os.environ.get('COHORT_METRIC_STORE')
+shared_metrics = metric_store.MetricStore(METRIC_STORE_DIR) if METRIC_STORE_DIR else None
+
+# download of the user ids behind the cohort counts
+MEMBERS_PATH = '/cohort_members.csv'
+
+# rows of a table sent to the browser at once
+TABLE_PAGE_SIZE = 12
+
+
+def DataVersion():
+    '''
+    Returns a key that changes whenever an export is added, removed or modified.
+    '''
+    version=[]
+    for path in sorted(glob.glob(EXPORT_PATTERN)):
+        stat=os.stat(path)
+        version.append((path,stat.st_size,stat.st_mtime_ns))
+    # a new version of the shared metrics clears the cached metrics and layouts too
+    if shared_metrics is not None:
+        version.append(('metric_store',shared_metrics.Version()))
+    return tuple(version)
+
+
+@cache.Memoize(orders_cache)
+def CompletedOrders(version):
+    '''
+    Returns the completed orders since 2018 of all the exports.
+    '''
+    # every export is merged into the local order store, which only appends new or changed orders
+    store = order_store.OrderStore()
+    with profiling.Stage('store.ingest'):
+        store.IngestAll(EXPORT_PATTERN)
+    with profiling.Stage('store.orders'):
+        order = store.Orders()
+
+    order = order[order.state=='complete']
+
+    # delete anything before 2018, if any
+    return order[order.completed_at.dt.year>=2018]
+
+
+def ComputeMetrics(version):
+    '''
+    Returns every series and cohort table shown in the dashboard for all the completed orders.
+    '''
+    if shared_metrics is not None:
+        return shared_metrics.Metrics()
+
+    order = CompletedOrders(version)
+
+    # closed months are kept in the metric state, only the latest month is recomputed
+    with profiling.Stage('state.update'):
+        state = metric_state.LoadMetricState(sources=version)
+        state.Update(order,version)
+        state.Save()
+
+    monthly_table = state.MonthlyTable()
+
+    # cohort with absolute and percentage values, order counts and revenue
+    with profiling.Stage('state.cohort_tables'):
+        cohort_tables=state.CohortTables()
+
+    # only the subscribers are grouped, the survival table is computed from the orders every time
+    with profiling.Stage('subscription_survival'):
+        months=periods.Periods(order,'Month')
+        is_renewal,recurring_count=methods.SubscriptionColumns(months.orders)
+        survival_df=methods.SubscriptionSurvival(months.UserIds(),months.positions,is_renewal,recurring_count,months.CohortNames())
+
+    metrics={
+        'period_names':['{:02d}/{}'.format(month[0],month[1]) for month in state.Months()],
+        'total_users':monthly_table['total_users'].tolist(),
+        'new_users':monthly_table['new_users'].tolist(),
+        'repeating_users':monthly_table['repeating_users'].tolist(),
+        'customers_lifetime':monthly_table['customers_lifetime'].tolist(),
+        'basket_value':monthly_table['basket_value'].tolist(),
+        'customers_lifetime_value':monthly_table['customers_lifetime_value'].tolist(),
+        'organic_repeating_users':monthly_table['organic_repeating_users'].tolist(),
+        'renewal_users':monthly_table['renewal_users'].tolist(),
+        'renewal_orders':monthly_table['renewal_orders'].tolist(),
+        'survival_df':survival_df,
+    }
+    metrics.update(zip(pipeline.COHORT_TABLES,cohort_tables))
+    return metrics
+
+
+def SegmentStrings(values):
+    '''
+    Returns the values of a segment column as the strings shown in the segment dropdown.
+    Ids stored as floats (store_id, float because of the missing values) read 1, not 1.0.
+    '''
+    return values.astype(object).map(lambda value: str(int(value)) if isinstance(value,float) and value.is_integer() else str(value))
+
+
+@cache.Memoize(metrics_cache)
+def FilteredMetrics(version,start_date,end_date,granularity,segment_column,segment_value):
+    '''
+    Returns the dashboard metrics of the completed orders between start_date and end_date
+    (both included) whose segment_column is segment_value, at granularity.
+    Without any filter the metrics come from the incremental metric state.
+    '''
+    filtered = start_date or end_date or (segment_column and segment_value is not None)
+    if not filtered and granularity == 'Month':
+        return ComputeMetrics(version)
+
+    order = CompletedOrders(version)
+    if start_date:
+        order = order[order.completed_at >= pd.Timestamp(start_date)]
+    if end_date:
+        order = order[order.completed_at < pd.Timestamp(end_date) + pd.Timedelta(days=1)]
+    if segment_column and segment_value is not None:
+        order = order[(SegmentStrings(order[segment_column]) == segment_value).values]
+
+    if order.shape[0] == 0:
+        return EmptyMetrics()
+
+    return pipeline.Metrics(order,granularity)
+
+
+@cache.Memoize(index_cache)
+def MembershipIndex(version):
+    '''
+    Returns the monthly cohort membership index of all the completed orders.
+    '''
+    if shared_metrics is not None:
+        return cohort_query.CohortIndex.FromMetricStore(shared_metrics)
+    return cohort_query.CohortIndex.FromOrders(CompletedOrders(version))
+
+
+@cache.Memoize(pages_cache)
+def TablePage(version,start_date,end_date,granularity,segment_column,segment_value,table,page):
+    '''
+    Returns the styled rows of a page of a table of the filtered metrics.
+    Pages past the end of the table (left over from other filters) show the last page.
+    '''
+    metrics=FilteredMetrics(version,start_date,end_date,granularity,segment_column,segment_value)
+    page=min(page or 0,methods.PageCount(metrics[table],TABLE_PAGE_SIZE)-1)
+    return methods.ConditionalTable(metrics[table],page*TABLE_PAGE_SIZE,(page+1)*TABLE_PAGE_SIZE)
+
+
+def PageOptions(table_df):
+    '''
+    Returns the options of the page selector of a table, named after the first and last period of every page.
+    '''
+    names=table_df[table_df.columns[0]].tolist()
+    options=[]
+    for page in range(methods.PageCount(table_df,TABLE_PAGE_SIZE)):
+        page_names=names[page*TABLE_PAGE_SIZE:(page+1)*TABLE_PAGE_SIZE]
+        label='{} to {}'.format(page_names[0],page_names[-1]) if page_names else 'No rows'
+        options.append({'label': label, 'value': page})
+    return options
+
+
+def EmptyMetrics():
+    '''
+    Returns metrics without any period, laid out like the result of ComputeMetrics.
+    '''
+    metrics={name:[] for name in ['period_names'] + pipeline.SERIES + pipeline.RENEWAL_SERIES}
+    metrics['abs_cohort_df']=pd.DataFrame(columns=['Month','NC'])
+    metrics['per_cohort_df']=pd.DataFrame(columns=['Month','NC'])
+    metrics['orders_cohort_df']=pd.DataFrame(columns=['Month'])
+    metrics['revenue_cohort_df']=pd.DataFrame(columns=['Month'])
+    metrics['survival_df']=pd.DataFrame(columns=['Month','Subscribers'])
+    return metrics
 
-order = pd.read_csv('query_result_2018-05-28T11_01_55.232Z.csv')
-
-order = order[order.state=='complete']
-
-all_users = order.user_id.unique()
-
-# sort df by customer creation time
-date_columns=[ value for value in order.columns.values if '_at' in value]
-for column in date_columns:
-    order[column] = pd.to_datetime(order[column])
-
-# group data by month-year
-completed_per_month=order.groupby([order.completed_at.dt.month,order.completed_at.dt.year])
-
-sorted_completed_months_keys = list(completed_per_month.groups.keys())
-sorted_completed_months_keys.sort(key=operator.itemgetter(1,0))
-
-# delete anything before 2018, if any
-sorted_completed_months_keys = [month_tuple for month_tuple in sorted_completed_months_keys if month_tuple[1]>=2018]
-
-
-###############################
-################################
-x_values_months=[month_indx for month_indx,_ in enumerate(sorted_completed_months_keys)]
-
-total_users=[]
-for month in sorted_completed_months_keys:
-    total_users.append(methods.MonthlyTotalUsers(month,completed_per_month)[0])
-
-##################################
-##################################
-new_users=[]
-for month in sorted_completed_months_keys:
-    new_users.append(methods.MonthlyNewUsers(month,sorted_completed_months_keys,completed_per_month)[0])
 
 ##################################
 ##################################
-repeating_users=[]
-for month in sorted_completed_months_keys:
-    repeating_users.append(methods.MonthlyRepeatingUsers(month,sorted_completed_months_keys,completed_per_month)[0])
-##################################
-##################################
-customers_lifetime=[]
-for month in sorted_completed_months_keys:
-    customers_lifetime.append(methods.CustomerLifetime(month,sorted_completed_months_keys,completed_per_month))
 
-##################################
-##################################
-customers_lifetime_value=[]
-for month in sorted_completed_months_keys:
-    customers_lifetime_value.append(methods.CustomerLifetimeValue(month,sorted_completed_months_keys,completed_per_month))
+# graphs of the dashboard: id, metric, title and y axis
+USER_GRAPHS = [
+    ('total-users-per-month','total_users','Total customers (TC)',{'title': 'TC'}),
+    ('new-users-per-month','new_users','New customers (NC)',{'title': 'NC'}),
+    ('repeating-users-per-month','repeating_users','Repeating customers (RC)',{'title': 'RC'}),
+]
+
+VALUE_GRAPHS = [
+    ('customer-lifetime-per-month','customers_lifetime','Customers Lifetime (CL)',{'title': 'CL'}),
+    ('basket-value','basket_value','Avg Basket Value (BV)',{'title': 'BV','range':[0.0,50.0]}),
+    ('customer-lifetime-value-per-month','customers_lifetime_value','Customers Lifetime Value (CLV)',{'title': 'CLV'}),
+]
+
+# repeating users split by whether they came back on their own or through a subscription renewal
+RENEWAL_GRAPHS = [
+    ('organic-repeating-users-per-month','organic_repeating_users','Organic repeating customers (ORC)',{'title': 'ORC'}),
+    ('renewal-users-per-month','renewal_users','Renewing customers (RNC)',{'title': 'RNC'}),
+    ('renewal-orders-per-month','renewal_orders','Renewal orders (RNO)',{'title': 'RNO'}),
+]
+
+# user tables are shown under the user graphs, order and revenue tables under the value graphs
+COHORT_TABLES = [
+    ('abs-cohort-table','abs_cohort_df','Repeating Custumers Month by Month (absolute)'),
+    ('per-cohort-table','per_cohort_df','Repeating Custumers Month by Month (percentage)'),
+    ('orders-cohort-table','orders_cohort_df','Orders per Cohort Month by Month'),
+    ('revenue-cohort-table','revenue_cohort_df','Revenue per Cohort Month by Month'),
+]
+
+SUBSCRIPTION_TABLES = [
+    ('survival-table','survival_df','Subscription Survival by Renewals'),
+]
+
+
+def LineFigure(period_names,values,title,yaxis,granularity='Month'):
+    '''
+    Returns the figure of a metric over time.
+    '''
+    x_values=[index for index,_ in enumerate(period_names)]
+    x_title = 'Time ({})'.format(periods.TIME_FORMATS[granularity])
+
+    return {
+        'data': [go.Scatter(
+                    x=x_values,
+                    y=values,
+                    mode='lines+markers',
+                    opacity=0.7,
+                    marker={
+                        'size': 15,
+                        'line': {'width': 0.5, 'color': 'white'}
+                    },
+                    name='plot'
+                    )],
+        'layout': go.Layout(
+            title=title,
+            xaxis={'title': x_title,
+                    'ticktext':period_names,
+                    'tickvals':x_values,
+                    },
+            yaxis=yaxis,
+            margin=go.Margin(
+                    l=50,
+                    r=10,
+                    b=100,
+                    t=100,
+                    pad=4
+                )
+        )}
+
+
+def GraphFigure(metrics,metric,title,yaxis):
+    # lifetime and value metrics stay monthly when the users are split by another granularity
+    if metric in pipeline.MONTHLY_SERIES and 'month_names' in metrics:
+        return LineFigure(metrics['month_names'],metrics[metric],title,yaxis)
+
+    return LineFigure(metrics['period_names'],metrics[metric],title,yaxis,metrics.get('granularity','Month'))
+
+
+def BuildControls():
+    '''
+    Returns the date range, granularity and segment filters.
+    '''
+    return html.Div([
+        html.Div([
+            html.Label('Completed between'),
+            dcc.DatePickerRange(id='date-range',clearable=True),
+        ],className='four columns'),
+        html.Div([
+            html.Label('Granularity'),
+            dcc.RadioItems(
+                id='granularity',
+                options=[{'label': granularity, 'value': granularity} for granularity in DASHBOARD_GRANULARITIES],
+                value='Month',
+                labelStyle={'display': 'inline-block'}
+            ),
+        ],className='two columns'),
+        html.Div([
+            html.Label('Segment'),
+            dcc.Dropdown(
+                id='segment-column',
+                options=[{'label': column, 'value': column} for column in SEGMENT_COLUMNS],
+                placeholder='All orders'
+            ),
+        ],className='three columns'),
+        html.Div([
+            html.Label('Segment value'),
+            dcc.Dropdown(id='segment-value',options=[]),
+        ],className='three columns'),
+    ],className='row')
+
+
+def BuildMembersDownload(metrics):
+    '''
+    Returns the month selectors and the link downloading the user ids of a cohort as CSV.
+    '''
+    options=[{'label': name, 'value': name} for name in metrics['period_names']]
+    return html.Div([
+        html.Div([
+            html.Label('Cohort'),
+            dcc.Dropdown(id='members-cohort',options=options,placeholder='All users'),
+        ],className='three columns'),
+        html.Div([
+            html.Label('Active in'),
+            dcc.Dropdown(id='members-active',options=options,multi=True),
+        ],className='three columns'),
+        html.Div([
+            html.Label('Not active in'),
+            dcc.Dropdown(id='members-inactive',options=options,multi=True),
+        ],className='three columns'),
+        html.Div([
+            html.A('Download user ids',id='members-download',href=MEMBERS_PATH,download='cohort_members.csv'),
+        ],className='three columns'),
+    ],className='row')
+
+
+def BuildLayout(metrics):
+    '''
+    Returns the dashboard layout showing metrics, as returned by ComputeMetrics.
+    '''
+    def Graphs(graphs):
+        return html.Div([
+            html.Div([
+                dcc.Graph(id=graph_id,figure=GraphFigure(metrics,metric,title,yaxis))
+            ],className='four columns')
+            for graph_id,metric,title,yaxis in graphs
+        ],className="row")
+
+    def Tables(tables):
+        return html.Div([
+            html.Div([
+                html.H6(children=title,style={'textAlign': 'center'}),
+                # only the first page is sent with the layout, the others come from the page callbacks
+                dcc.Dropdown(
+                    id=table_id+'-page',
+                    options=PageOptions(metrics[table]),
+                    value=0,
+                    clearable=False
+                ),
+                dt.DataTable(
+                    rows=methods.ConditionalTable(metrics[table],0,TABLE_PAGE_SIZE),
+                    columns=metrics[table].columns,
+                    row_height=40.0,
+                    column_width=120.0,
+                    header_row_height=40.0,
+                    min_height=245,
+                    id=table_id
+                )
+            ],className='six columns')
+            for table_id,table,title in tables
+        ],className="row")
+
+    return html.Div([
+
+        html.H1(children='Month-Based Analysis',style={'textAlign': 'center'}),
+
+        BuildControls(),
+
+        Graphs(USER_GRAPHS),
+
+        Tables(COHORT_TABLES[:2]),
+
+        BuildMembersDownload(metrics),
+
+        Graphs(VALUE_GRAPHS),
+
+        Tables(COHORT_TABLES[2:]),
+
+        Graphs(RENEWAL_GRAPHS),
+
+        Tables(SUBSCRIPTION_TABLES),
+    ])
+
+
+def ServeLayout():
+    '''
+    Returns the dashboard layout. It is built on the first request after the exports
+    change and served from layout_cache afterwards.
+    '''
+    # dash calls the layout once when it is assigned, outside of any request:
+    # an empty layout registers the components without computing anything
+    if not flask.has_request_context():
+        return BuildLayout(EmptyMetrics())
+
+    def Compute():
+        metrics=FilteredMetrics(version,None,None,'Month',None,None)
+        with profiling.Stage('dashboard.layout'):
+            return BuildLayout(metrics)
+
+    version=DataVersion()
+    return layout_cache.GetOrCompute(version,Compute)
 
-##################################
-##################################
 
-basket_value=[]
-for month in sorted_completed_months_keys:
-    basket_value.append(methods.BasketValue(month,sorted_completed_months_keys,completed_per_month))
+# dashboard definition
+app = dash.Dash()
 
-##################################
-##################################
+# a function, so that nothing is computed before the server starts
+app.layout = ServeLayout
 
-# tables definition in the following
-# each table is defined by a dataframe
+# stage timings on /_profile, recorded when COHORT_PROFILE is set
+profiling.RegisterRoutes(app.server)
 
-column_list = ['Month','NC']
-for index,_ in enumerate(sorted_completed_months_keys[1:]):
-    column_list.append('Month {}'.format(index+1))
+# user ids behind the cohort counts, as CSV
+cohort_query.RegisterRoutes(app.server,lambda: MembershipIndex(DataVersion()),MEMBERS_PATH)
 
-# cohort with absolute values
-abs_cohort_df = pd.DataFrame(columns=column_list)
+FILTERS = [
+    Input('date-range','start_date'),
+    Input('date-range','end_date'),
+    Input('granularity','value'),
+    Input('segment-column','value'),
+    Input('segment-value','value'),
+]
 
-for index,start_month in enumerate(sorted_completed_months_keys):
 
-    month_cohort=['{}-{}'.format(start_month[0],start_month[1])]
+@app.callback(Output('segment-value','options'),[Input('segment-column','value')])
+def SegmentValues(segment_column):
+    if not segment_column:
+        return []
 
-    total_nc=methods.MonthlyNewUsers(start_month,sorted_completed_months_keys,completed_per_month)[0]
-    month_cohort.append(total_nc)
+    values=CompletedOrders(DataVersion())[segment_column].dropna()
+    # sorted on the values, so that store 2 comes before store 10
+    values=SegmentStrings(pd.Series(sorted(values.unique()),dtype=object)).unique()
+    return [{'label': value, 'value': value} for value in values]
 
-    for end_month in sorted_completed_months_keys[index+1:]:
-        repeat=methods.MonthlyRepeatingUsersStartEnd(start_month,end_month,sorted_completed_months_keys,completed_per_month)
-        month_cohort.append(repeat[0])
 
-    for _ in range(len(column_list)-len(month_cohort)):
-        month_cohort.append(math.nan)
-    
-    month_df = pd.DataFrame([month_cohort],columns=column_list)
-    abs_cohort_df = abs_cohort_df.append(month_df,ignore_index=True)
+@app.callback(Output('members-download','href'),
+              [Input('members-cohort','value'),Input('members-active','value'),Input('members-inactive','value')])
+def MembersLink(cohort,active_in,inactive_in):
+    query=[('cohort',cohort)] if cohort else []
+    query+=[('active_in',period) for period in active_in or []]
+    query+=[('inactive_in',period) for period in inactive_in or []]
+    return MEMBERS_PATH + ('?' + urllib.parse.urlencode(query) if query else '')
 
-# cohort with percentage values
-per_cohort_df = pd.DataFrame(columns=column_list)
 
-for index,start_month in enumerate(sorted_completed_months_keys):
-    month_cohort=['{}-{}'.format(start_month[0],start_month[1])]
+def GraphCallback(metric,title,yaxis):
+    def UpdateGraph(start_date,end_date,granularity,segment_column,segment_value):
+        metrics=FilteredMetrics(DataVersion(),start_date,end_date,granularity,segment_column,segment_value)
+        return GraphFigure(metrics,metric,title,yaxis)
+    return UpdateGraph
 
-    total_nc=methods.MonthlyNewUsers(start_month,sorted_completed_months_keys,completed_per_month)[0]
-    month_cohort.append(total_nc)
 
-    for end_month in sorted_completed_months_keys[index+1:]:
-        repeat=methods.MonthlyRepeatingUsersStartEnd(start_month,end_month,sorted_completed_months_keys,completed_per_month)[0]
-        month_cohort.append(repeat/total_nc)
+def TableCallbacks(table):
+    # the metrics of a filter combination are computed once and shared by all the callbacks,
+    # the styled rows of a page once per page
+    def UpdateRows(start_date,end_date,granularity,segment_column,segment_value,page):
+        return TablePage(DataVersion(),start_date,end_date,granularity,segment_column,segment_value,table,page)
 
-    for _ in range(len(column_list)-len(month_cohort)):
-        month_cohort.append(math.nan)
-    
-    month_df = pd.DataFrame([month_cohort],columns=column_list)
-    per_cohort_df = per_cohort_df.append(month_df,ignore_index=True)
+    def UpdateColumns(start_date,end_date,granularity,segment_column,segment_value):
+        metrics=FilteredMetrics(DataVersion(),start_date,end_date,granularity,segment_column,segment_value)
+        return list(metrics[table].columns)
 
+    def UpdatePages(start_date,end_date,granularity,segment_column,segment_value):
+        metrics=FilteredMetrics(DataVersion(),start_date,end_date,granularity,segment_column,segment_value)
+        return PageOptions(metrics[table])
 
-# dashboard definition
-app = dash.Dash()
+    return UpdateRows,UpdateColumns,UpdatePages
 
-app.layout = html.Div([
 
-    html.H1(children='Month-Based Analysis',style={'textAlign': 'center'}),
+def FirstPage(start_date,end_date,granularity,segment_column,segment_value):
+    return 0
 
-    html.Div([
-        html.Div([
-            dcc.Graph(
-                    id='total-users-per-month',
-                    figure={
-                        'data': [go.Scatter(
-                                    x=x_values_months,
-                                    y=total_users,
-                                    #text=None,
-                                    mode='lines+markers',
-                                    opacity=0.7,
-                                    marker={
-                                        'size': 15,
-                                        'line': {'width': 0.5, 'color': 'white'}
-                                    },
-                                    name='plot'
-                                    )],
-                        'layout': go.Layout(
-                            title='Total customers (TC)',
-                            xaxis={'title': 'Time (mm/yyyy)',
-                                    'ticktext':['{:02d}/{}'.format(month[0],month[1]) for month in sorted_completed_months_keys],
-                                    'tickvals':x_values_months,
-                                    },
-                            yaxis={'title': 'TC'},
-                            margin=go.Margin(
-                                    l=50,
-                                    r=10,
-                                    b=100,
-                                    t=100,
-                                    pad=4
-                                )
-                            #legend={'x': 0, 'y': 1},
-                            #hovermode='closest'
-                        )}
-            )
-        ],className='four columns'),
-        html.Div([
-            dcc.Graph(
-                    id='new-users-per-month',
-                    figure={
-                        'data': [go.Scatter(
-                                    x=x_values_months,
-                                    y=new_users,
-                                    #text=None,
-                                    mode='lines+markers',
-                                    opacity=0.7,
-                                    marker={
-                                        'size': 15,
-                                        'line': {'width': 0.5, 'color': 'white'}
-                                    },
-                                    name='plot'
-                                    )],
-                        'layout': go.Layout(
-                            title='New customers (NC)',
-                            xaxis={'title': 'Time (mm/yyyy)',
-                                    'ticktext':['{:02d}/{}'.format(month[0],month[1]) for month in sorted_completed_months_keys],
-                                    'tickvals':x_values_months,
-                                    },
-                            yaxis={'title': 'NC'},
-                            margin=go.Margin(
-                                    l=50,
-                                    r=10,
-                                    b=100,
-                                    t=100,
-                                    pad=4
-                                )
-                            #legend={'x': 0, 'y': 1},
-                            #hovermode='closest'
-                        )
-                    })
-        ],className='four columns'),
-        html.Div([
-            dcc.Graph(
-                id='repeating-users-per-month',
-                figure={
-                    'data': [go.Scatter(
-                                x=x_values_months,
-                                y=repeating_users,
-                                #text=None,
-                                mode='lines+markers',
-                                opacity=0.7,
-                                marker={
-                                    'size': 15,
-                                    'line': {'width': 0.5, 'color': 'white'}
-                                },
-                                name='plot'
-                                )],
-                    'layout': go.Layout(
-                        title='Repeating customers (RC)',
-                        xaxis={'title': 'Time (mm/yyyy)',
-                                'ticktext':['{:02d}/{}'.format(month[0],month[1]) for month in sorted_completed_months_keys],
-                                'tickvals':x_values_months,
-                                },
-                        yaxis={'title': 'RC'},
-                        margin=go.Margin(
-                                    l=50,
-                                    r=10,
-                                    b=100,
-                                    t=100,
-                                    pad=4
-                                )
-                        #margin={'l': 40, 'b': 40, 't': 10, 'r': 10},
-                        #legend={'x': 0, 'y': 1},
-                        #hovermode='closest'
-                    )
-            })
-        ],className='four columns')
-    ],className="row"),
-
-    html.Div([
-        html.Div([
-            html.H6(children='Repeating Custumers Month by Month (absolute)',style={'textAlign': 'center'}),
-            dt.DataTable(
-                rows=methods.ConditionalTable(abs_cohort_df),
-                columns=abs_cohort_df.columns,
-                row_height=40.0,
-                column_width=120.0,
-                header_row_height=40.0,
-                min_height=245,
-                id='table'
-            )
-        ],className='six columns'),
-        html.Div([
-            html.H6(children='Repeating Custumers Month by Month (percentage)',style={'textAlign': 'center'}),
-            dt.DataTable(
-                rows=methods.ConditionalTable(per_cohort_df),
-                columns=per_cohort_df.columns,
-                row_height=40.0,
-                column_width=120.0,
-                header_row_height=40.0,
-                min_height=245.0,
-                id='table'
-            )
-        ],className='six columns')
-    ],className="row"),
-
-    html.Div([
-        html.Div([
-            dcc.Graph(
-                id='customer-lifetime-per-month',
-                figure={
-                    'data': [go.Scatter(
-                                x=x_values_months,
-                                y=customers_lifetime,
-                                #text=None,
-                                mode='lines+markers',
-                                opacity=0.7,
-                                marker={
-                                    'size': 15,
-                                    'line': {'width': 0.5, 'color': 'white'}
-                                },
-                                name='plot'
-                                )],
-                    'layout': go.Layout(
-                        title='Customers Lifetime (CL)',
-                        xaxis={'title': 'Time (mm/yyyy)',
-                                'ticktext':['{:02d}/{}'.format(month[0],month[1]) for month in sorted_completed_months_keys],
-                                'tickvals':x_values_months,
-                                },
-                        yaxis={'title': 'CL'},
-                        margin=go.Margin(
-                                    l=50,
-                                    r=10,
-                                    b=100,
-                                    t=100,
-                                    pad=4
-                                )
-                        #margin={'l': 40, 'b': 40, 't': 10, 'r': 10},
-                        #legend={'x': 0, 'y': 1},
-                        #hovermode='closest'
-                    )
-            })
-        ],className='four columns'),
-        html.Div([
-            dcc.Graph(
-                id='basket-value',
-                figure={
-                    'data': [go.Scatter(
-                                x=x_values_months,
-                                y=basket_value,
-                                #text=None,
-                                mode='lines+markers',
-                                opacity=0.7,
-                                marker={
-                                    'size': 15,
-                                    'line': {'width': 0.5, 'color': 'white'}
-                                },
-                                name='plot'
-                                )],
-                    'layout': go.Layout(
-                        title='Avg Basket Value (BV)',
-                        xaxis={'title': 'Time (mm/yyyy)',
-                                'ticktext':['{:02d}/{}'.format(month[0],month[1]) for month in sorted_completed_months_keys],
-                                'tickvals':x_values_months,
-                                },
-                        yaxis={'title': 'BV','range':[0.0,50.0]},
-                        margin=go.Margin(
-                                    l=50,
-                                    r=10,
-                                    b=100,
-                                    t=100,
-                                    pad=4
-                                )
-                        #margin={'l': 40, 'b': 40, 't': 10, 'r': 10},
-                        #legend={'x': 0, 'y': 1},
-                        #hovermode='closest'
-                    )
-            })
-        ],className='four columns'),
 
+for graph_id,metric,title,yaxis in USER_GRAPHS + VALUE_GRAPHS + RENEWAL_GRAPHS:
+    app.callback(Output(graph_id,'figure'),FILTERS)(GraphCallback(metric,title,yaxis))
 
-        html.Div([
-            dcc.Graph(
-                id='customer-lifetime-value-per-month',
-                figure={
-                    'data': [go.Scatter(
-                                x=x_values_months,
-                                y=customers_lifetime_value,
-                                #text=None,
-                                mode='lines+markers',
-                                opacity=0.7,
-                                marker={
-                                    'size': 15,
-                                    'line': {'width': 0.5, 'color': 'white'}
-                                },
-                                name='plot'
-                                )],
-                    'layout': go.Layout(
-                        title='Customers Lifetime Value (CLV)',
-                        xaxis={'title': 'Time (mm/yyyy)',
-                                'ticktext':['{:02d}/{}'.format(month[0],month[1]) for month in sorted_completed_months_keys],
-                                'tickvals':x_values_months,
-                                },
-                        yaxis={'title': 'CLV'},
-                        margin=go.Margin(
-                                    l=50,
-                                    r=10,
-                                    b=100,
-                                    t=100,
-                                    pad=4
-                                )
-                        #margin={'l': 40, 'b': 40, 't': 10, 'r': 10},
-                        #legend={'x': 0, 'y': 1},
-                        #hovermode='closest'
-                    )
-            })
-        ],className='four columns')
-    ],className="row")
-])
+for table_id,table,_ in COHORT_TABLES + SUBSCRIPTION_TABLES:
+    update_rows,update_columns,update_pages=TableCallbacks(table)
+    app.callback(Output(table_id,'rows'),FILTERS + [Input(table_id+'-page','value')])(update_rows)
+    app.callback(Output(table_id,'columns'),FILTERS)(update_columns)
+    app.callback(Output(table_id+'-page','options'),FILTERS)(update_pages)
+    # other filters start again from the first page
+    app.callback(Output(table_id+'-page','value'),FILTERS)(FirstPage)
 
 app.css.append_css({
     'external_url': 'https://codepen.io/chriddyp/pen/bWLwgP.css'
@@ -385,6 +514,3 @@ app.css.append_css({
 
 if __name__ == '__main__':
     app.run_server()
-
-
-
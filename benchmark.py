@@ -0,0 +1,336 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+import loader
+import methods
+import metric_state
+import order_store
+import periods
+import pipeline
+
+# columns of the Spree query_result exports, in export order
+EXPORT_COLUMNS = ['id','additional_tax_total','adjustment_total','approved_at','approver_id','bill_address_id',
+                  'canceled_at','canceler_id','channel','completed_at','confirmation_delivered','considered_risky',
+                  'created_at','created_by_id','currency','email','guest_token','included_tax_total','is_renewal',
+                  'item_count','item_total','last_ip_address','non_taxable_adjustment_total','number','payment_state',
+                  'payment_total','promo_total','recurring_count','ship_address_id','shipment_state','shipment_total',
+                  'special_instructions','state','state_lock_version','store_id','taxable_adjustment_total','total',
+                  'updated_at','user_id']
+
+DEFAULT_SIZES = [10**3,10**4,10**5,10**6,10**7]
+
+DEFAULT_REPORT = 'benchmark_report.json'
+
+
+##############################
+# Synthetic orders
+##############################
+
+def SyntheticOrders(num_users,num_months=12,orders_per_user=3.0,churn=0.3,
+                    subscriber_fraction=0.1,canceled_fraction=0.03,start='2018-01-01',seed=0):
+    '''
+    Returns synthetic orders with the columns and dtypes of a loaded Spree export.
+    Every user starts in a random month and stays for a geometric number of months
+    (a user leaves after each month with probability churn); its orders, on average
+    orders_per_user, are spread over the months it stays. The first order of a subscriber
+    starts its subscription (recurring_count 1) and its later orders are renewals.
+    '''
+    random=np.random.RandomState(seed)
+
+    first_month=random.randint(0,num_months,num_users)
+    months_stayed=np.minimum(random.geometric(churn,num_users),num_months - first_month)
+    user_orders=1 + random.poisson(max(orders_per_user - 1.0,0.0),num_users)
+    subscriber=random.rand(num_users) < subscriber_fraction
+
+    num_orders=int(user_orders.sum())
+    user_index=np.repeat(np.arange(num_users),user_orders)
+    # the first order of every user is in its first month
+    order_rank=np.arange(num_orders) - np.repeat(np.cumsum(user_orders) - user_orders,user_orders)
+    month=first_month[user_index] + np.where(order_rank == 0,0,(random.rand(num_orders)*months_stayed[user_index]).astype(int))
+
+    start=pd.Timestamp(start)
+    month_start=pd.DatetimeIndex([start + pd.DateOffset(months=int(index)) for index in range(num_months)])
+    completed_at=pd.to_datetime(month_start.values[month]) + pd.to_timedelta(random.randint(0,28*24*3600,num_orders),unit='s')
+
+    order=pd.DataFrame({'completed_at':completed_at,'user_id':(user_index + 1).astype(float)})
+    order['is_renewal']=subscriber[user_index] & (order_rank > 0)
+    order['recurring_count']=np.where(subscriber[user_index],order_rank + 1,0).astype(float)
+    order=order.sort_values('completed_at',kind='mergesort').reset_index(drop=True)
+
+    item_total=np.round(random.gamma(4.0,8.0,num_orders),0)
+    adjustment_total=np.where(random.rand(num_orders) < 0.1,-np.round(item_total*0.1,2),0.0)
+    shipment_total=np.where(item_total < 30,4.9,0.0)
+    canceled=random.rand(num_orders) < canceled_fraction
+
+    order['id']=np.arange(1,num_orders + 1)
+    order['number']=['R{:09d}'.format(number) for number in order['id']]
+    order['state']=np.where(canceled,'canceled','complete')
+    order['payment_state']=np.where(canceled,'void','paid')
+    order['shipment_state']=np.where(canceled,'canceled','shipped')
+    order['item_count']=random.randint(1,8,num_orders).astype(float)
+    order['item_total']=item_total
+    order['adjustment_total']=adjustment_total
+    order['promo_total']=adjustment_total
+    order['shipment_total']=shipment_total
+    order['total']=item_total + adjustment_total + shipment_total
+    order['payment_total']=np.where(canceled,0.0,order['total'])
+    order['included_tax_total']=np.round(order['total']*0.07,2)
+    order['additional_tax_total']=0.0
+    order['non_taxable_adjustment_total']=0.0
+    order['taxable_adjustment_total']=adjustment_total
+    order['created_at']=order['completed_at'] - pd.to_timedelta(random.randint(60,7*24*3600,num_orders),unit='s')
+    order['updated_at']=order['completed_at'] + pd.to_timedelta(random.randint(60,7*24*3600,num_orders),unit='s')
+    order['approved_at']=pd.NaT
+    order['canceled_at']=order['updated_at'].where(canceled)
+    order['approver_id']=np.nan
+    order['canceler_id']=np.where(canceled,order['user_id'],np.nan)
+    order['created_by_id']=order['user_id']
+    order['bill_address_id']=order['id']*2
+    order['ship_address_id']=order['id']*2 + 1
+    order['channel']='spree'
+    order['currency']='EUR'
+    order['store_id']=1.0
+    order['email']=['user{}@example.com'.format(int(user)) for user in order['user_id']]
+    order['guest_token']=['token{:012d}'.format(number) for number in order['id']]
+    order['last_ip_address']='127.0.0.1'
+    order['special_instructions']=np.nan
+    order['confirmation_delivered']=True
+    order['considered_risky']=False
+    order['state_lock_version']=0
+
+    for column,dtype in loader.ORDER_DTYPES.items():
+        order[column]=order[column].astype(dtype)
+
+    return order[EXPORT_COLUMNS]
+
+
+def WriteSyntheticExport(path,order):
+    '''
+    Writes synthetic orders in the format of a query_result export.
+    '''
+    order=order.copy()
+    # booleans are exported as true/false
+    for column in ['is_renewal','confirmation_delivered','considered_risky']:
+        order[column]=np.where(order[column],'true','false')
+
+    order.to_csv(path,index=False,float_format='%.2f',date_format=loader.ISO_FORMAT)
+
+
+def SyntheticOrdersOfSize(num_orders,orders_per_user=3.0,**parameters):
+    '''
+    Returns synthetic orders with about num_orders orders.
+    '''
+    num_users=max(int(num_orders / orders_per_user),1)
+    return SyntheticOrders(num_users,orders_per_user=orders_per_user,**parameters)
+
+
+##############################
+# Timing
+##############################
+
+def Time(function,repeat=1):
+    '''
+    Returns the best wall time of repeat calls of function, in seconds.
+    '''
+    best=None
+    for _ in range(repeat):
+        start=time.perf_counter()
+        function()
+        elapsed=time.perf_counter() - start
+        best = elapsed if best is None else min(best,elapsed)
+    return best
+
+
+def Context(order):
+    '''
+    Returns what the benchmarked functions take as arguments, as built by the dashboard.
+    '''
+    completed=order[order.state=='complete']
+    sorted_completed_months_keys,completed_per_month=pipeline.GroupByMonth(completed)
+    abs_cohort_df,per_cohort_df=methods.CohortTables(sorted_completed_months_keys,completed_per_month)
+
+    return {
+        'order':completed,
+        'keys':sorted_completed_months_keys,
+        'groups':completed_per_month,
+        'user_index':methods.UserIndex(sorted_completed_months_keys,completed_per_month),
+        'per_cohort_df':per_cohort_df,
+    }
+
+
+def EveryMonth(function,with_index=False):
+    # the dashboard calls the per-month functions once per month
+    def run(context):
+        for month in context['keys']:
+            if with_index:
+                function(month,context['keys'],context['groups'],context['user_index'])
+            else:
+                function(month,context['keys'],context['groups'])
+    return run
+
+
+def EveryMonthPair(context):
+    keys=context['keys']
+    for index,start_month in enumerate(keys):
+        for end_month in keys[index+1:]:
+            methods.MonthlyRepeatingUsersStartEnd(start_month,end_month,keys,context['groups'],context['user_index'])
+
+
+def ExportPipeline(context):
+    '''
+    Loads the export and computes every metric and table with the pipeline, as the report CLI does.
+    '''
+    order=loader.ReadOrdersCsv(context['export_path'])
+    order=order[order.state=='complete']
+    metrics=pipeline.MonthlyMetrics(order)
+    for table in pipeline.COHORT_TABLES:
+        methods.ConditionalTable(metrics[table])
+
+
+def DashboardPipeline(context):
+    '''
+    Computes the dashboard tables the way Analysis does on a new version of the exports:
+    ingests the export into an order store, folds the orders into a saved metric state
+    and computes the survival table from the orders. Store and state start empty.
+    '''
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(context['export_path'])) as directory:
+        store=order_store.OrderStore(os.path.join(directory,'order_store'))
+        store.Ingest(context['export_path'])
+        order=store.Orders()
+        order=order[order.state=='complete']
+
+        state=metric_state.LoadMetricState(os.path.join(directory,'metric_state.pkl'))
+        state.Update(order)
+        state.Save(os.path.join(directory,'metric_state.pkl'))
+        state.MonthlyTable()
+
+        months=periods.Periods(order,'Month')
+        is_renewal,recurring_count=methods.SubscriptionColumns(months.orders)
+        methods.SubscriptionSurvival(months.UserIds(),months.positions,is_renewal,recurring_count,months.CohortNames())
+        for cohort_df in state.CohortTables():
+            methods.ConditionalTable(cohort_df)
+
+
+BENCHMARKS = [
+    ('MonthlyNewUsers',EveryMonth(methods.MonthlyNewUsers)),
+    ('MonthlyRepeatingUsers',EveryMonth(methods.MonthlyRepeatingUsers)),
+    ('MonthlyRepeatingUsersStartEnd',EveryMonthPair),
+    ('CustomerLifetime',EveryMonth(methods.CustomerLifetime,with_index=True)),
+    ('CustomerLifetimeValue',EveryMonth(methods.CustomerLifetimeValue,with_index=True)),
+    ('BasketValue',EveryMonth(methods.BasketValue)),
+    ('WeeklyNewUsers',EveryMonth(methods.WeeklyNewUsers)),
+    ('ConditionalTable',lambda context: methods.ConditionalTable(context['per_cohort_df'])),
+    ('CohortTables',lambda context: methods.CohortTables(context['keys'],context['groups'])),
+    ('CohortMatrices',lambda context: methods.CohortMatrices(context['keys'],context['groups'])),
+    ('ExportPipeline',ExportPipeline),
+    ('DashboardPipeline',DashboardPipeline),
+]
+
+
+def RunBenchmarks(sizes=DEFAULT_SIZES,names=None,repeat=1,max_seconds=60.0,generator_parameters=None):
+    '''
+    Times every benchmark on synthetic orders of every size and returns the results.
+    Every benchmark is run once untimed first, so that lazy imports and first-call costs
+    are not timed. A benchmark slower than max_seconds is skipped for the larger sizes.
+    '''
+    generator_parameters=generator_parameters or {}
+    too_slow=set()
+    results=[]
+
+    for size in sizes:
+        order=SyntheticOrdersOfSize(size,**generator_parameters)
+        context=Context(order)
+
+        with tempfile.TemporaryDirectory() as directory:
+            context['export_path']=os.path.join(directory,'query_result_synthetic.csv')
+            WriteSyntheticExport(context['export_path'],order)
+
+            for name,benchmark in BENCHMARKS:
+                if (names and name not in names) or name in too_slow:
+                    continue
+
+                benchmark(context)
+                seconds=Time(lambda: benchmark(context),repeat)
+                results.append({'function':name,'orders':int(order.shape[0]),'months':len(context['keys']),'seconds':seconds})
+                print('{:<32}{:>10} orders {:>10.4f} s'.format(name,order.shape[0],seconds))
+
+                if seconds > max_seconds:
+                    too_slow.add(name)
+
+    return results
+
+
+def Report(results,parameters):
+    return {
+        'created':time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python':sys.version.split()[0],
+        'numpy':np.__version__,
+        'pandas':pd.__version__,
+        'platform':platform.platform(),
+        'parameters':parameters,
+        'results':results,
+    }
+
+
+def Regressions(report,baseline,tolerance=0.2):
+    '''
+    Returns the results of report more than tolerance slower than the same benchmark in baseline.
+    '''
+    baseline_seconds={(result['function'],result['orders']):result['seconds'] for result in baseline['results']}
+
+    regressions=[]
+    for result in report['results']:
+        key=(result['function'],result['orders'])
+        if key in baseline_seconds and result['seconds'] > baseline_seconds[key]*(1.0 + tolerance):
+            regressions.append(dict(result,baseline_seconds=baseline_seconds[key]))
+    return regressions
+
+
+def Main(argv=None):
+    parser=argparse.ArgumentParser(description='Times the cohort metrics on synthetic Spree orders.')
+    parser.add_argument('--sizes',type=lambda value: [int(float(size)) for size in value.split(',')],default=DEFAULT_SIZES,
+                        help='comma separated numbers of orders, e.g. 1e3,1e4')
+    parser.add_argument('--functions',type=lambda value: value.split(','),default=None)
+    parser.add_argument('--months',type=int,default=12)
+    parser.add_argument('--orders-per-user',type=float,default=3.0)
+    parser.add_argument('--churn',type=float,default=0.3)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--repeat',type=int,default=1)
+    parser.add_argument('--max-seconds',type=float,default=60.0)
+    parser.add_argument('--output',default=DEFAULT_REPORT)
+    parser.add_argument('--baseline',help='report to compare with, exits with 1 on regressions')
+    parser.add_argument('--tolerance',type=float,default=0.2)
+    arguments=parser.parse_args(argv)
+
+    generator_parameters={
+        'num_months':arguments.months,
+        'orders_per_user':arguments.orders_per_user,
+        'churn':arguments.churn,
+        'seed':arguments.seed,
+    }
+    results=RunBenchmarks(arguments.sizes,arguments.functions,arguments.repeat,arguments.max_seconds,generator_parameters)
+
+    report=Report(results,dict(generator_parameters,sizes=arguments.sizes,repeat=arguments.repeat))
+    with open(arguments.output,'w') as report_file:
+        json.dump(report,report_file,indent=2)
+
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            regressions=Regressions(report,json.load(baseline_file),arguments.tolerance)
+        for regression in regressions:
+            print('regression: {function} at {orders} orders, {seconds:.4f} s instead of {baseline_seconds:.4f} s'.format(**regression))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -0,0 +1,98 @@
+import collections
+import functools
+import threading
+import time
+
+
+class TTLCache(object):
+    '''
+    Least recently used cache holding at most maxsize entries.
+    If ttl is set, entries older than ttl seconds are recomputed.
+    '''
+
+    def __init__(self,maxsize=16,ttl=None):
+        self.maxsize=maxsize
+        self.ttl=ttl
+        self.entries=collections.OrderedDict()
+        self.lock=threading.RLock()
+        # keys being computed -> lock held during the computation
+        self.computing={}
+        self.hits=0
+        self.misses=0
+
+    def _Expired(self,created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def Get(self,key,default=None):
+        '''
+        Returns the value cached for key, or default if it is missing or expired.
+        '''
+        with self.lock:
+            if key not in self.entries:
+                return default
+
+            created,value=self.entries[key]
+            if self._Expired(created):
+                del self.entries[key]
+                return default
+
+            self.entries.move_to_end(key)
+            return value
+
+    def Set(self,key,value):
+        with self.lock:
+            self.entries[key]=(time.time(),value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def GetOrCompute(self,key,compute):
+        '''
+        Returns the value cached for key, calling compute() to fill the cache if needed.
+        Concurrent callers of the same key wait for a single computation instead of running their own.
+        '''
+        missing=object()
+        value=self.Get(key,missing)
+        if value is not missing:
+            self.hits+=1
+            return value
+
+        with self.lock:
+            key_lock=self.computing.setdefault(key,threading.Lock())
+
+        try:
+            with key_lock:
+                value=self.Get(key,missing)
+                if value is not missing:
+                    self.hits+=1
+                    return value
+
+                self.misses+=1
+                value=compute()
+                self.Set(key,value)
+                return value
+        finally:
+            with self.lock:
+                self.computing.pop(key,None)
+
+    def Clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def Memoize(cache):
+    '''
+    Decorator caching the results of a function in cache, keyed on its arguments.
+    Arguments must be hashable.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args,**kwargs):
+            key=(function.__name__,args,tuple(sorted(kwargs.items())))
+            return cache.GetOrCompute(key,lambda: function(*args,**kwargs))
+        wrapper.cache=cache
+        return wrapper
+    return decorator
@@ -0,0 +1,149 @@
+import io
+import numpy as np
+import pandas as pd
+
+import metric_store
+import periods
+import userset
+
+##############################
+# Membership queries on the users behind the cohort counts.
+# The index reads the distinct (user, period) activity sorted by user then period, as published
+# by the metric store, without copying it: user -> periods are slices of it, and the bitmaps
+# of the active and new users of a period are built on the first query of the period.
+# A query combines the bitmaps (cohort of X & active in Y - active in Z)
+# and only turns the result back into user ids.
+##############################
+
+
+class CohortIndex(object):
+    '''
+    Inverted index of the activity of the users, over contiguous periods.
+    Periods are given by name (as in the metrics period_names) or by position.
+    activity_users and activity_periods are the distinct (user, period) pairs sorted by user
+    then period, as metric_store.Activity; they are kept as they are, so memory-mapped
+    arrays stay shared between the processes.
+    '''
+
+    def __init__(self,activity_users,activity_periods,period_names):
+        self.period_names=list(period_names)
+        self.period_index={name:index for index,name in enumerate(self.period_names)}
+
+        # user -> periods, one slice of user_periods per user
+        num_pairs=activity_users.shape[0]
+        user_start=np.flatnonzero(activity_users[1:] != activity_users[:-1]) + 1
+        if num_pairs:
+            user_start=np.concatenate([[0],user_start])
+        self.users=np.asarray(activity_users[user_start])
+        self.user_periods=activity_periods
+        self.user_offsets=np.append(user_start,num_pairs)
+        self.first_period=np.asarray(activity_periods[user_start])
+
+        self.active_sets={}
+        self.cohort_sets={}
+
+    @classmethod
+    def FromOrders(cls,order,granularity='Month',start=None):
+        '''
+        Returns the index of the completed orders at granularity.
+        '''
+        period_set=periods.Periods(order,granularity,start)
+        activity_users,activity_periods=metric_store.Activity(period_set.UserIds(),period_set.positions)
+        return cls(activity_users,activity_periods,period_set.Names())
+
+    @classmethod
+    def FromMetricStore(cls,store):
+        '''
+        Returns the index of the monthly activity published in a metric_store.MetricStore.
+        '''
+        user_ids,positions,period_names=store.Activity()
+        return cls(user_ids,positions,period_names)
+
+    def Period(self,period):
+        '''
+        Returns the position of a period given by name or position.
+        '''
+        if isinstance(period,str):
+            if period not in self.period_index:
+                raise ValueError('unknown period {!r}'.format(period))
+            return self.period_index[period]
+
+        position=int(period)
+        if not 0 <= position < len(self.period_names):
+            raise ValueError('period {} out of range'.format(period))
+        return position
+
+    def Active(self,period):
+        '''
+        Returns the users active in period, as a userset.UserSet.
+        '''
+        position=self.Period(period)
+        if position not in self.active_sets:
+            # the user of every pair of the period, as positions in self.users
+            codes=np.searchsorted(self.user_offsets,np.flatnonzero(self.user_periods == position),side='right') - 1
+            self.active_sets[position]=userset.UserSet.FromCodes(self.users,codes)
+        return self.active_sets[position]
+
+    def Cohort(self,period):
+        '''
+        Returns the users whose first period is period, as a userset.UserSet.
+        '''
+        position=self.Period(period)
+        if position not in self.cohort_sets:
+            self.cohort_sets[position]=userset.UserSet.FromCodes(self.users,np.flatnonzero(self.first_period == position))
+        return self.cohort_sets[position]
+
+    def Members(self,cohort=None,active_in=(),inactive_in=()):
+        '''
+        Returns the users of cohort (all the users if None) active in every period of active_in
+        and in none of inactive_in, as a userset.UserSet.
+        '''
+        if cohort is not None:
+            members=self.Cohort(cohort)
+        else:
+            members=userset.UserSet.FromCodes(self.users,np.arange(self.users.shape[0]))
+        for period in active_in:
+            members=members & self.Active(period)
+        for period in inactive_in:
+            members=members - self.Active(period)
+        return members
+
+    def UserPeriods(self,user):
+        '''
+        Returns the names of the periods in which user was active.
+        '''
+        position=np.searchsorted(self.users,user)
+        if position == self.users.shape[0] or self.users[position] != user:
+            return []
+        user_periods=self.user_periods[self.user_offsets[position]:self.user_offsets[position+1]]
+        return [self.period_names[period] for period in user_periods]
+
+
+def MembersCsv(members):
+    '''
+    Returns the user ids of a userset.UserSet as CSV text, one user_id per line.
+    '''
+    output=io.StringIO()
+    pd.DataFrame({'user_id':members.Users()}).to_csv(output,index=False)
+    return output.getvalue()
+
+
+def RegisterRoutes(server,index,path='/cohort_members.csv'):
+    '''
+    Serves the members of a query as a CSV download on path, for example
+    ?cohort=04/2018&active_in=05/2018 or ?active_in=04/2018&inactive_in=05/2018.
+    index is called on every request and returns the CohortIndex to query.
+    '''
+    import flask
+
+    def Members():
+        arguments=flask.request.args
+        try:
+            members=index().Members(arguments.get('cohort') or None,arguments.getlist('active_in'),arguments.getlist('inactive_in'))
+        except ValueError as error:
+            flask.abort(400,str(error))
+
+        return flask.Response(MembersCsv(members),mimetype='text/csv',
+                              headers={'Content-Disposition':'attachment; filename=cohort_members.csv'})
+
+    server.add_url_rule(path,'cohort_members',Members)
@@ -0,0 +1,126 @@
+import math
+import numpy as np
+
+##############################
+# HyperLogLog sketches of user ids, for approximate distinct counts.
+# A sketch is an array of 2**precision registers (one byte each), so a month of
+# users costs 4 KB at the default precision whatever the number of users.
+# Sketches are merged with an elementwise maximum: the sketch of a union is exact,
+# only the count read from it is approximate.
+##############################
+
+DEFAULT_PRECISION = 12
+
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+
+
+def RelativeError(precision=DEFAULT_PRECISION):
+    '''
+    Returns the relative standard error of a count read from a sketch, 1.04 / sqrt(2**precision):
+    about 1.6% at the default precision, 68% of the counts are within one error of the exact count
+    and 95% within two.
+    '''
+    return 1.04 / math.sqrt(1 << precision)
+
+
+def HashUsers(user_ids):
+    '''
+    Returns a 64 bit hash (splitmix64) of every user id.
+    '''
+    values=np.asarray(user_ids).astype(np.int64).view(np.uint64)
+    with np.errstate(over='ignore'):
+        values=values + np.uint64(0x9E3779B97F4A7C15)
+        values=(values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values=(values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def _BitLength(values):
+    length=np.zeros(values.shape,dtype=np.int64)
+    for shift in (32,16,8,4,2,1):
+        high=values >> np.uint64(shift)
+        has_high=high != 0
+        length[has_high]+=shift
+        values=np.where(has_high,high,values)
+    return length + (values != 0)
+
+
+def _Registers(hashes,precision):
+    '''
+    Returns the register and the rank (position of the first set bit) of every hash.
+    '''
+    suffix_bits=64 - precision
+    registers=(hashes >> np.uint64(suffix_bits)).astype(np.int64)
+    suffixes=hashes & np.uint64((1 << suffix_bits) - 1)
+    ranks=suffix_bits - _BitLength(suffixes) + 1
+    return registers,ranks.astype(np.uint8)
+
+
+def PeriodRegisters(user_ids,positions,num_periods,precision=DEFAULT_PRECISION):
+    '''
+    Returns a (periods x 2**precision) array holding the sketch of the users of every period,
+    built in one pass over the (user, period) pairs. Missing user ids (guests) are left out.
+    '''
+    if not MIN_PRECISION <= precision <= MAX_PRECISION:
+        raise ValueError('precision must be between {} and {}'.format(MIN_PRECISION,MAX_PRECISION))
+
+    num_registers=1 << precision
+    user_ids=np.asarray(user_ids)
+    # NaN is the only value not equal to itself
+    known=user_ids == user_ids
+    registers,ranks=_Registers(HashUsers(user_ids[known]),precision)
+
+    sketches=np.zeros(num_periods*num_registers,dtype=np.uint8)
+    np.maximum.at(sketches,np.asarray(positions,dtype=np.int64)[known]*num_registers + registers,ranks)
+    return sketches.reshape(num_periods,num_registers)
+
+
+def Estimate(registers):
+    '''
+    Returns the approximate number of distinct users of sketches, one per row of registers
+    (or a single count for a single sketch). Small counts use linear counting.
+    '''
+    registers=np.asarray(registers)
+    num_registers=registers.shape[-1]
+    alpha=0.7213 / (1 + 1.079 / num_registers)
+
+    raw=alpha * num_registers * num_registers / np.exp2(-registers.astype(float)).sum(axis=-1)
+    zeros=(registers == 0).sum(axis=-1)
+    with np.errstate(divide='ignore'):
+        linear=num_registers * np.log(num_registers / np.maximum(zeros,1))
+
+    return np.where((raw <= 2.5 * num_registers) & (zeros > 0),linear,raw)
+
+
+class HyperLogLog(object):
+    '''
+    Sketch of a set of users. Sketches of the same precision are merged with |.
+    '''
+
+    def __init__(self,precision=DEFAULT_PRECISION,registers=None):
+        self.precision=precision
+        if registers is None:
+            registers=np.zeros(1 << precision,dtype=np.uint8)
+        self.registers=registers
+
+    @classmethod
+    def FromUsers(cls,user_ids,precision=DEFAULT_PRECISION):
+        user_ids=np.asarray(user_ids)
+        return cls(precision,PeriodRegisters(user_ids,np.zeros(user_ids.shape[0],dtype=np.int64),1,precision)[0])
+
+    def Add(self,user_ids):
+        user_ids=np.asarray(user_ids)
+        sketch=PeriodRegisters(user_ids,np.zeros(user_ids.shape[0],dtype=np.int64),1,self.precision)[0]
+        np.maximum(self.registers,sketch,out=self.registers)
+
+    def __or__(self,other):
+        if self.precision != other.precision:
+            raise ValueError('sketches of different precisions can not be merged')
+        return HyperLogLog(self.precision,np.maximum(self.registers,other.registers))
+
+    def Count(self):
+        return float(Estimate(self.registers))
+
+    def RelativeError(self):
+        return RelativeError(self.precision)
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import tempfile
+import pandas as pd
+
+import profiling
+
+try:
+    import pyarrow
+    CACHE_FORMAT='parquet'
+    CACHE_EXTENSION='.parquet'
+except ImportError:
+    # without pyarrow the cache falls back to pickle, which keeps the dtypes as well
+    CACHE_FORMAT='pickle'
+    CACHE_EXTENSION='.pkl'
+
+##############################
+# Schema of the Spree order exports (query_result_*.csv).
+# Only the columns listed here are ever parsed.
+##############################
+
+ORDER_DTYPES = {
+    'id':'int64',
+    # guest orders have no user, hence float
+    'user_id':'float64',
+    'state':'category',
+    'payment_state':'category',
+    'shipment_state':'category',
+    'channel':'category',
+    'currency':'category',
+    'store_id':'float64',
+    'item_count':'float64',
+    'total':'float64',
+    'item_total':'float64',
+    # subscriptions, only in the exports since 2018-05-28; nullable so that older exports can be merged
+    'is_renewal':'boolean',
+    'recurring_count':'float64',
+}
+
+DATE_COLUMNS = ['completed_at','created_at','updated_at']
+
+ISO_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# columns used by the dashboard
+DEFAULT_COLUMNS = ['id','user_id','state','completed_at','total','item_total','is_renewal','recurring_count']
+
+DEFAULT_CACHE_DIR = '.order_cache'
+
+
+def ParseDates(values):
+    '''
+    Converts a column of ISO 8601 timestamps as written by the Spree export.
+    The explicit format is much faster than letting pandas guess it; anything
+    that does not match it goes through the generic parser.
+    '''
+    try:
+        return pd.to_datetime(values,format=ISO_FORMAT)
+    except ValueError:
+        return pd.to_datetime(values)
+
+
+def ReadOrdersCsv(path,columns=DEFAULT_COLUMNS):
+    '''
+    Reads an order export keeping only columns, with the dtypes of ORDER_DTYPES.
+    Columns missing from the export are skipped, since older exports have fewer columns.
+    '''
+    wanted=set(columns)
+    with profiling.Stage('loader.read_csv'):
+        order=pd.read_csv(path,
+                          usecols=lambda column: column in wanted,
+                          dtype={column:dtype for column,dtype in ORDER_DTYPES.items() if column in wanted})
+
+    with profiling.Stage('loader.parse_dates'):
+        for column in DATE_COLUMNS:
+            if column in order.columns:
+                order[column]=ParseDates(order[column])
+
+    return order
+
+
+def CacheKey(path,columns):
+    '''
+    Returns a key that changes whenever the source file or the requested columns change.
+    '''
+    stat=os.stat(path)
+    key='{}|{}|{}|{}|{}'.format(os.path.abspath(path),stat.st_size,stat.st_mtime_ns,','.join(columns),CACHE_FORMAT)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _CachePrefix(path,columns):
+    # caches of the same export and columns share the prefix, whatever the version of the file
+    name,_=os.path.splitext(os.path.basename(path))
+    return '{}-{}-'.format(name,hashlib.sha1(','.join(columns).encode('utf-8')).hexdigest()[:8])
+
+
+def CachePath(path,columns,cache_dir=None):
+    '''
+    Returns the path of the cached copy of an export.
+    '''
+    if cache_dir is None:
+        cache_dir=os.path.join(os.path.dirname(os.path.abspath(path)),DEFAULT_CACHE_DIR)
+
+    return os.path.join(cache_dir,'{}{}{}'.format(_CachePrefix(path,columns),CacheKey(path,columns)[:16],CACHE_EXTENSION))
+
+
+def WriteFrame(frame,path):
+    '''
+    Writes frame in the cache format, through a temporary file of its own so that
+    readers never see a half written file and concurrent writers never mix their content.
+    '''
+    directory,name=os.path.split(os.path.abspath(path))
+    descriptor,temporary_path=tempfile.mkstemp(prefix=name+'.',suffix='.tmp',dir=directory)
+    os.close(descriptor)
+    try:
+        if CACHE_FORMAT == 'parquet':
+            frame.to_parquet(temporary_path)
+        else:
+            frame.to_pickle(temporary_path)
+        os.replace(temporary_path,path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def ReadFrame(path,columns=None):
+    '''
+    Reads a frame written by WriteFrame, optionally only some of its columns.
+    '''
+    if CACHE_FORMAT == 'parquet':
+        return pd.read_parquet(path,columns=columns)
+
+    frame=pd.read_pickle(path)
+    if columns is not None:
+        frame=frame[columns]
+    return frame
+
+
+def LoadOrders(path,columns=DEFAULT_COLUMNS,cache_dir=None,use_cache=True):
+    '''
+    Returns the orders of an export as a typed dataframe.
+    The parsed dataframe is cached in columnar format next to the export
+    (or in cache_dir), so later calls on the same unchanged file skip CSV parsing.
+    '''
+    if not use_cache:
+        return ReadOrdersCsv(path,columns)
+
+    cache_path=CachePath(path,columns,cache_dir)
+    if os.path.exists(cache_path):
+        return ReadFrame(cache_path)
+
+    order=ReadOrdersCsv(path,columns)
+
+    os.makedirs(os.path.dirname(cache_path),exist_ok=True)
+    WriteFrame(order,cache_path)
+
+    # drop the caches of older versions of the same export and columns,
+    # the caches of other column sets and the files other writers are writing are kept
+    prefix=_CachePrefix(path,columns)
+    cache_dir=os.path.dirname(cache_path)
+    for cache_file in os.listdir(cache_dir):
+        if cache_file.startswith(prefix) and cache_file.endswith(CACHE_EXTENSION) and os.path.join(cache_dir,cache_file) != cache_path:
+            try:
+                os.remove(os.path.join(cache_dir,cache_file))
+            except FileNotFoundError:
+                pass
+
+    return order
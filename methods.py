@@ -1,6 +1,13 @@
+import math
+import sys
+import warnings
 import numpy as np
 import pandas as pd
-import dash_html_components as html
+
+import hyperloglog
+import periods
+import profiling
+import userset
 
 def MonthlyTotalUsers(month,completed_per_month):
     '''
@@ -10,11 +17,16 @@ def MonthlyTotalUsers(month,completed_per_month):
 
     return total.shape[0],total
 
-def MonthlyNewUsers(month,sorted_completed_months_keys,completed_per_month):
+def MonthlyNewUsers(month,sorted_completed_months_keys,completed_per_month,user_index=None):
     '''
     Returns the total number of users that completed an order in the current month
     and never completed any order before.
+    If a UserIndex is given the answer is read from it.
     '''
+    if user_index is not None:
+        new_users=user_index.NewUsers(month)
+        return new_users.shape[0],new_users
+
     current_users= completed_per_month.get_group(month)['user_id'].unique()
     current_month_index = sorted_completed_months_keys.index(month)
 
@@ -30,11 +42,18 @@ def MonthlyNewUsers(month,sorted_completed_months_keys,completed_per_month):
     else:
         return current_users.shape[0],current_users
     
-def MonthlyRepeatingUsers(month,sorted_completed_months_keys,completed_per_month):
+def MonthlyRepeatingUsers(month,sorted_completed_months_keys,completed_per_month,user_index=None):
     '''
     Returns the number of user that completed at least one order this month
     and also completed at least one order in the months before. 
+    If a UserIndex is given the answer is read from it.
     '''
+    if user_index is not None:
+        if user_index.month_index[month] == 0:
+            return 0.0,[]
+        repeated_users=user_index.RepeatingUsers(month)
+        return repeated_users.shape[0],repeated_users
+
     current_month_users= completed_per_month.get_group(month)['user_id'].unique()
     current_month_index = sorted_completed_months_keys.index(month)
 
@@ -50,23 +69,456 @@ def MonthlyRepeatingUsers(month,sorted_completed_months_keys,completed_per_month
 
         return repeated_users.shape[0],repeated_users
 
-def MonthlyRepeatingUsersStartEnd(start_month,end_month,sorted_completed_months_keys,completed_per_month):
+def MonthlyRepeatingUsersStartEnd(start_month,end_month,sorted_completed_months_keys,completed_per_month,user_index=None):
     '''
     repeating users from end_month
     new users from start_month
     '''
+    if user_index is not None:
+        repeated_users=CohortMembers(start_month,end_month,user_index).Users()
+        return repeated_users.shape[0],repeated_users
+
     start_month_index=sorted_completed_months_keys.index(start_month)
     end_month_index=sorted_completed_months_keys.index(end_month)
 
-    end_month_repeat=MonthlyRepeatingUsers(end_month,sorted_completed_months_keys,completed_per_month)[1]
-    start_month_new_users=MonthlyNewUsers(start_month,sorted_completed_months_keys,completed_per_month)[1]
+    end_month_repeat=MonthlyRepeatingUsers(end_month,sorted_completed_months_keys,completed_per_month,user_index)[1]
+    start_month_new_users=MonthlyNewUsers(start_month,sorted_completed_months_keys,completed_per_month,user_index)[1]
     #start_month_users=completed_per_month.get_group(sorted_completed_months_keys[start_month_index])['user_id'].unique()
     
     repeated_users = np.intersect1d(start_month_new_users,end_month_repeat)
 
     return repeated_users.shape[0],repeated_users
 
+def CohortMembers(start_month,end_month,user_index):
+    '''
+    Returns the users that completed their first order in start_month and
+    also completed an order in end_month, as a userset.UserSet.
+    '''
+    if user_index.month_index[end_month] <= user_index.month_index[start_month]:
+        return userset.UserSet.Empty(user_index.users)
+
+    return user_index.NewUserSet(start_month) & user_index.ActiveUserSet(end_month)
+
+def _MonthPositions(sorted_completed_months_keys,completed_per_month):
+    '''
+    Returns the completed orders that fall in one of the sorted months,
+    together with the index of their month in sorted_completed_months_keys.
+    '''
+    orders=completed_per_month.obj
+    month_codes=np.array([periods.MonthCode(month,year) for month,year in sorted_completed_months_keys],dtype='int64')
+    order_codes=periods.PeriodCodes(orders['completed_at'],'Month')
+
+    if month_codes.shape[0] == 0:
+        return orders[:0],order_codes[:0]
+
+    positions=np.minimum(np.searchsorted(month_codes,order_codes),month_codes.shape[0]-1)
+    in_sorted_months = month_codes[positions] == order_codes
+    return orders[in_sorted_months],positions[in_sorted_months]
+
+class UserIndex(object):
+    '''
+    Index of the completed orders, built once and shared by the monthly functions.
+    For every user it holds the month of the first completed order and the sorted
+    months in which the user completed at least one order; for every month the bitmaps
+    (userset.UserSet) of its active and new users, from which the new and repeating users are read.
+    Months are stored as their index in sorted_completed_months_keys.
+    '''
+
+    def __init__(self,sorted_completed_months_keys,completed_per_month):
+        orders,positions=_MonthPositions(sorted_completed_months_keys,completed_per_month)
+
+        self.month_index={month:index for index,month in enumerate(sorted_completed_months_keys)}
+
+        activity=pd.DataFrame({'user_id':orders['user_id'].values,'month':positions}).dropna().drop_duplicates()
+
+        # user -> months, one slice of active_months per user
+        activity=activity.sort_values(['user_id','month'])
+        self.users,user_start=np.unique(activity['user_id'].values,return_index=True)
+        self.active_months=activity['month'].values
+        self.active_offsets=np.append(user_start,self.active_months.shape[0])
+        self.first_month=self.active_months[user_start]
+
+    def NewUsers(self,month):
+        '''
+        Returns the sorted users whose first completed order is in month, as np.setdiff1d would.
+        '''
+        return self.NewUserSet(month).Users()
+
+    def RepeatingUsers(self,month):
+        '''
+        Returns the sorted users that completed an order in month and in at least one month before,
+        as np.intersect1d would.
+        '''
+        return (self.ActiveUserSet(month) - self.NewUserSet(month)).Users()
+
+    def _BuildUserSets(self):
+        # bitmaps over self.users, built on first use
+        user_codes=np.repeat(np.arange(self.users.shape[0]),np.diff(self.active_offsets))
+        is_new=(self.active_months == np.repeat(self.first_month,np.diff(self.active_offsets)))
+
+        by_month=np.argsort(self.active_months,kind='mergesort')
+        user_codes=user_codes[by_month]
+        is_new=is_new[by_month]
+        bounds=np.searchsorted(self.active_months[by_month],np.arange(len(self.month_index)+1))
+
+        self.active_sets=[]
+        self.new_sets=[]
+        for index in range(len(self.month_index)):
+            month_codes=user_codes[bounds[index]:bounds[index+1]]
+            month_is_new=is_new[bounds[index]:bounds[index+1]]
+            self.active_sets.append(userset.UserSet.FromCodes(self.users,month_codes))
+            self.new_sets.append(userset.UserSet.FromCodes(self.users,month_codes[month_is_new]))
+
+    def ActiveUserSet(self,month):
+        '''
+        Returns the users that completed an order in month, as a userset.UserSet.
+        '''
+        if not hasattr(self,'active_sets'):
+            self._BuildUserSets()
+        return self.active_sets[self.month_index[month]]
+
+    def NewUserSet(self,month):
+        '''
+        Returns the users whose first completed order is in month, as a userset.UserSet.
+        '''
+        if not hasattr(self,'new_sets'):
+            self._BuildUserSets()
+        return self.new_sets[self.month_index[month]]
+
+    def UserMonths(self,user):
+        '''
+        Returns the sorted indexes of the months in which user completed at least one order.
+        '''
+        position=np.searchsorted(self.users,user)
+        if position == self.users.shape[0] or self.users[position] != user:
+            return self.active_months[:0]
+        return self.active_months[self.active_offsets[position]:self.active_offsets[position+1]]
+
+def _UserActivity(user_ids,positions,**columns):
+    '''
+    Returns the orders as rows of user_id, period and columns, without the guest orders:
+    guests have no user_id, they count in the order sums but not as users.
+    '''
+    activity=pd.DataFrame(dict({'user_id':user_ids,'period':positions},**columns))
+    return activity[activity['user_id'].notnull().values]
+
+def PeriodCohortCounts(user_ids,positions,num_periods):
+    '''
+    Returns a (periods x periods) matrix where entry [i,k] is the number of users
+    whose first period is i and that are active in period i+k.
+    '''
+    activity=_UserActivity(user_ids,positions).drop_duplicates()
+    first_period=activity.groupby('user_id')['period'].transform('min').values
+    offset=activity['period'].values - first_period
+
+    counts=np.bincount(first_period*num_periods + offset,minlength=num_periods*num_periods)
+    return counts.reshape(num_periods,num_periods)
+
+def PeriodUsers(user_ids,positions,num_periods):
+    '''
+    Returns the number of total, new and repeating users of every period.
+    '''
+    activity=_UserActivity(user_ids,positions).drop_duplicates()
+    first_period=activity.groupby('user_id')['period'].transform('min').values
+    periods=activity['period'].values
+
+    total_users=np.bincount(periods,minlength=num_periods)
+    new_users=np.bincount(periods[first_period == periods],minlength=num_periods)
+
+    return total_users,new_users,total_users - new_users
+
+def PeriodLifetime(user_ids,positions,num_periods):
+    '''
+    Returns the customer lifetime of every period: the average, over the users active in the
+    period, of the number of periods in which they were active up to that period.
+    '''
+    activity=_UserActivity(user_ids,positions).drop_duplicates()
+    activity=activity.sort_values(['user_id','period'])
+    periods_so_far=activity.groupby('user_id').cumcount().values + 1
+    periods=activity['period'].values
+
+    user_lifetime=np.bincount(periods,weights=periods_so_far,minlength=num_periods)
+    period_users=np.bincount(periods,minlength=num_periods)
+
+    # periods without users have no lifetime
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return user_lifetime / period_users
+
+def CohortCounts(sorted_completed_months_keys,completed_per_month):
+    '''
+    Returns a (months x months) matrix where entry [i,k] is the number of users
+    that completed their first order in month i and completed at least one order in month i+k.
+    Column 0 holds the number of new users of each month.
+    '''
+    orders,positions=_MonthPositions(sorted_completed_months_keys,completed_per_month)
+    num_months=len(sorted_completed_months_keys)
+
+    return PeriodCohortCounts(orders['user_id'].values,positions,num_months)
+
+def CohortTables(sorted_completed_months_keys,completed_per_month):
+    '''
+    Returns the cohort tables with absolute and percentage values, computed in a single pass.
+    Each row is the cohort of users that completed their first order in a month:
+    NC is the size of the cohort and Month k the users of the cohort that completed
+    at least one order k months later (same values as MonthlyRepeatingUsersStartEnd).
+    '''
+    counts=CohortCounts(sorted_completed_months_keys,completed_per_month)
+
+    return CohortTablesFromCounts(sorted_completed_months_keys,counts)
+
+def CohortTablesFromCounts(sorted_completed_months_keys,counts):
+    '''
+    Returns the cohort tables with absolute and percentage values of a matrix
+    laid out like the result of CohortCounts.
+    '''
+    month_names=['{}-{}'.format(month[0],month[1]) for month in sorted_completed_months_keys]
+
+    return _PeriodCohortTables(month_names,counts,'Month')
+
+def _PeriodCohortTables(period_names,counts,period_column):
+    num_periods=len(period_names)
+
+    column_list = [period_column,'NC']
+    for index in range(1,num_periods):
+        column_list.append('{} {}'.format(period_column,index))
+
+    abs_rows=[]
+    per_rows=[]
+    for index,period_name in enumerate(period_names):
+        total_nc=int(counts[index,0])
+        repeat=counts[index,1:num_periods-index]
+        padding=[math.nan]*index
+
+        with np.errstate(divide='ignore',invalid='ignore'):
+            per_repeat=(repeat/total_nc).tolist()
+
+        abs_rows.append([period_name,total_nc] + repeat.tolist() + padding)
+        per_rows.append([period_name,total_nc] + per_repeat + padding)
+
+    abs_cohort_df=pd.DataFrame(abs_rows,columns=column_list,dtype=object)
+    per_cohort_df=pd.DataFrame(per_rows,columns=column_list,dtype=object)
+
+    return abs_cohort_df,per_cohort_df
+
+def PeriodCohortMatrices(user_ids,positions,totals,num_periods,order_counts=None):
+    '''
+    Returns the user, order count and revenue cohort matrices, in a single grouped pass:
+    for the users whose first period is i, entry [i,k] is the number of them active in period i+k,
+    the number of orders they completed in period i+k and the sum of the total of those orders.
+    Each row stands for one order, or for order_counts orders if given.
+    '''
+    if order_counts is None:
+        order_counts=np.ones(len(user_ids),dtype='int64')
+    activity=_UserActivity(user_ids,positions,total=totals,orders=order_counts)
+    first_period=activity.groupby('user_id')['period'].transform('min').values
+    cells=first_period*num_periods + (activity['period'].values - first_period)
+    first_of_period=~activity.duplicated(['user_id','period']).values
+
+    size=num_periods*num_periods
+    users=np.bincount(cells[first_of_period],minlength=size)
+    orders=np.bincount(cells,weights=activity['orders'].values,minlength=size).astype('int64')
+    revenue=np.bincount(cells,weights=activity['total'].values,minlength=size)
+
+    shape=(num_periods,num_periods)
+    return users.reshape(shape),orders.reshape(shape),revenue.reshape(shape)
+
+def CohortMatrices(sorted_completed_months_keys,completed_per_month):
+    '''
+    Returns the user, order count and revenue cohort matrices of the sorted months,
+    laid out like the result of CohortCounts.
+    '''
+    orders,positions=_MonthPositions(sorted_completed_months_keys,completed_per_month)
+    num_months=len(sorted_completed_months_keys)
+
+    return PeriodCohortMatrices(orders['user_id'].values,positions,orders['total'].values,num_months)
 
+def CohortTablesFromMatrices(sorted_completed_months_keys,users,orders,revenue):
+    '''
+    Returns the user cohort tables with absolute and percentage values and the
+    order count and revenue cohort tables of matrices laid out like the result of CohortMatrices.
+    '''
+    month_names=['{}-{}'.format(month[0],month[1]) for month in sorted_completed_months_keys]
+
+    return PeriodCohortTables(month_names,users,orders,revenue,'Month')
+
+def PeriodCohortTables(period_names,users,orders,revenue,period_column):
+    '''
+    Returns the absolute, percentage, order count and revenue cohort tables of the periods.
+    Order count and revenue tables have one row per cohort and one column per period
+    after the first one, starting from the first one (<period_column> 0).
+    '''
+    abs_cohort_df,per_cohort_df=_PeriodCohortTables(period_names,users,period_column)
+
+    return abs_cohort_df,per_cohort_df,_PeriodValueTable(period_names,orders,period_column),_PeriodValueTable(period_names,revenue,period_column)
+
+def _PeriodValueTable(period_names,values,period_column):
+    num_periods=len(period_names)
+
+    column_list=[period_column] + ['{} {}'.format(period_column,index) for index in range(num_periods)]
+
+    rows=[]
+    for index,period_name in enumerate(period_names):
+        rows.append([period_name] + values[index,:num_periods-index].tolist() + [math.nan]*index)
+
+    return pd.DataFrame(rows,columns=column_list,dtype=object)
+
+##############################
+# Approximate distinct counts.
+# Every period keeps a HyperLogLog sketch of its users instead of the user ids:
+# the users seen up to a period are the union (elementwise maximum) of the sketches so far,
+# and intersections are read by inclusion-exclusion, |A & B| = |A| + |B| - |A | B|.
+# Counts read from one sketch (total users) have the relative error of hyperloglog.RelativeError;
+# new, repeating and cohort counts are differences of such counts: their error is absolute,
+# about the relative error times the number of users seen so far, whatever the size of the count.
+# Counts smaller than a few times that error are unreliable: on the bundled exports weekly
+# cohort cells of a few users come out more than 100% off.
+##############################
+
+def _Intersections(sketches,others):
+    # [i,j] -> approximate |sketches[i] & others[j]|, one row at a time to bound memory
+    unions=np.array([hyperloglog.Estimate(np.maximum(sketch[None,:],others)) for sketch in sketches]).reshape(sketches.shape[0],others.shape[0])
+    return hyperloglog.Estimate(sketches)[:,None] + hyperloglog.Estimate(others)[None,:] - unions
+
+def ApproximatePeriodUsers(sketches):
+    '''
+    Returns the approximate number of total, new and repeating users of every period,
+    and the approximate number of users seen up to every period.
+    '''
+    total_users=np.rint(hyperloglog.Estimate(sketches)).astype('int64')
+    seen_users=np.rint(hyperloglog.Estimate(np.maximum.accumulate(sketches,axis=0))).astype('int64')
+    seen_users=np.maximum.accumulate(seen_users)
+
+    new_users=np.minimum(np.diff(seen_users,prepend=0),total_users)
+    return total_users,new_users,total_users - new_users,seen_users
+
+def ApproximatePeriodLifetime(sketches):
+    '''
+    Returns the approximate customer lifetime of every period: the sum over the periods so far
+    of the users active both then and in the period, divided by the users of the period.
+    '''
+    num_periods=sketches.shape[0]
+    shared=np.clip(_Intersections(sketches,sketches),0,None)
+    shared=np.where(np.arange(num_periods)[:,None] <= np.arange(num_periods)[None,:],shared,0.0)
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return shared.sum(axis=0) / np.diag(shared)
+
+def ApproximatePeriodCohortCounts(sketches):
+    '''
+    Returns the approximate cohort matrix, laid out like PeriodCohortCounts.
+    The users of cohort i active in period j are the users seen up to i and active in j
+    minus the users seen up to i-1 and active in j. Every cell has an absolute standard error
+    of about the relative error times the users seen up to j, so small cells can be off
+    by more than their own value; negative estimates are clipped to 0.
+    '''
+    num_periods=sketches.shape[0]
+    seen=np.maximum.accumulate(sketches,axis=0)
+    seen_and_active=np.clip(_Intersections(seen,sketches),0,None)
+    seen_before_and_active=np.vstack([np.zeros((1,num_periods)),seen_and_active[:-1]])
+    cohort_active=np.clip(np.rint(seen_and_active - seen_before_and_active),0,None).astype('int64')
+
+    counts=np.zeros((num_periods,num_periods),dtype='int64')
+    for first_period in range(num_periods):
+        counts[first_period,:num_periods-first_period]=cohort_active[first_period,first_period:]
+    return counts
+
+def ApproximateCohortTables(period_names,sketches,period_column='Month'):
+    '''
+    Returns the cohort tables with absolute and percentage values of the period sketches.
+    Cells have the absolute error of ApproximatePeriodCohortCounts, percentages of small
+    cohorts are not meaningful.
+    '''
+    return _PeriodCohortTables(period_names,ApproximatePeriodCohortCounts(sketches),period_column)
+
+##############################
+# Subscriptions.
+# Orders with is_renewal set are subscription renewals and recurring_count is the rank
+# of an order in its subscription (1 for the order that started it, 0 for organic orders),
+# not always filled on renewals. Exports before 2018-05-28 have neither column:
+# all their orders are organic and there are no subscribers.
+##############################
+
+def SubscriptionColumns(orders):
+    '''
+    Returns is_renewal and recurring_count of the orders as arrays, missing values
+    (and missing columns) read as not a renewal and no recurrence.
+    '''
+    if 'is_renewal' in orders.columns:
+        is_renewal=orders['is_renewal'].fillna(False).values.astype(bool)
+    else:
+        is_renewal=np.zeros(orders.shape[0],dtype=bool)
+
+    if 'recurring_count' in orders.columns:
+        recurring_count=orders['recurring_count'].fillna(0).values.astype('int64')
+    else:
+        recurring_count=np.zeros(orders.shape[0],dtype='int64')
+
+    return is_renewal,recurring_count
+
+def PeriodRenewalUsers(user_ids,positions,is_renewal,num_periods):
+    '''
+    Returns the number of total, new, repeating, organic repeating and renewing users
+    of every period, in one grouped pass. A repeating user is organic if at least one of
+    its orders of the period is not a renewal, renewing otherwise.
+    '''
+    activity=_UserActivity(user_ids,positions,organic=~is_renewal)
+    activity=activity.groupby(['user_id','period'],sort=False,as_index=False)['organic'].any()
+    first_period=activity.groupby('user_id')['period'].transform('min').values
+    periods=activity['period'].values
+    repeating=periods != first_period
+
+    total_users=np.bincount(periods,minlength=num_periods)
+    new_users=np.bincount(periods[~repeating],minlength=num_periods)
+    organic_users=np.bincount(periods[repeating & activity['organic'].values],minlength=num_periods)
+
+    return total_users,new_users,total_users - new_users,organic_users,total_users - new_users - organic_users
+
+def SubscriptionSurvival(user_ids,positions,is_renewal,recurring_count,period_names,period_column='Month'):
+    '''
+    Returns the subscription survival table by recurring_count.
+    A subscriber is a user with a renewal or with an order whose recurring_count is positive.
+    Its subscription starts in the period of its first order and its length is its number of
+    renewals, or its highest recurring_count - 1 if higher (renewals older than the exports),
+    so a subscriber that never renewed has length 0. There is one row per period in which
+    subscriptions started and a last All row: Subscribers is their number and Renewal k the share
+    of them whose length is at least k.
+    '''
+    activity=_UserActivity(user_ids,positions,renewal=is_renewal,recurring_count=recurring_count,
+                           subscription=is_renewal | (recurring_count > 0))
+    subscribers=activity.groupby('user_id').agg(start=('period','min'),renewals=('renewal','sum'),
+                                                recurring_count=('recurring_count','max'),subscription=('subscription','any'))
+    subscribers=subscribers[subscribers['subscription'].values]
+    if subscribers.empty:
+        return pd.DataFrame(columns=[period_column,'Subscribers'])
+
+    length=np.maximum(subscribers['renewals'].values,subscribers['recurring_count'].values - 1).astype('int64')
+    start=subscribers['start'].values.astype('int64')
+
+    num_periods=len(period_names)
+    num_lengths=int(length.max()) + 1
+    counts=np.bincount(start*num_lengths + length,minlength=num_periods*num_lengths).reshape(num_periods,num_lengths)
+    counts=np.vstack([counts[counts.sum(axis=1) > 0],counts.sum(axis=0)])
+    names=[period_names[period] for period in np.flatnonzero(np.bincount(start,minlength=num_periods))] + ['All']
+
+    # [row,k] -> subscribers whose length is at least k
+    at_least=counts[:,::-1].cumsum(axis=1)[:,::-1]
+
+    column_list=[period_column,'Subscribers'] + ['Renewal {}'.format(index) for index in range(1,num_lengths)]
+    rows=[[name,int(row[0])] + (row[1:] / row[0]).tolist() for name,row in zip(names,at_least)]
+    return pd.DataFrame(rows,columns=column_list,dtype=object)
+
+##############################
+# Week based analysis.
+# The weekly series and cohort tables are pipeline.PeriodMetrics(order,'Week'),
+# the functions below split the users of one month week by week.
+##############################
+
+def ISOWeekNumbers(completed_at):
+    '''
+    Returns the ISO week number of every timestamp, as the removed .dt.week accessor did.
+    '''
+    thursdays=pd.DatetimeIndex(periods.PeriodStarts(periods.PeriodCodes(completed_at,'Week'),'Week') + 3)
+    return pd.Index((thursdays.dayofyear - 1) // 7 + 1,name='completed_at')
 
 def WeeklyNewUsers(month,sorted_completed_months_keys,completed_per_month):
     '''
@@ -75,7 +527,7 @@ def WeeklyNewUsers(month,sorted_completed_months_keys,completed_per_month):
     '''
     month_new_users=MonthlyNewUsers(month,sorted_completed_months_keys,completed_per_month)[1]
     month_group=completed_per_month.get_group(month)
-    completed_per_week=month_group.groupby([month_group.completed_at.dt.week])
+    completed_per_week=month_group.groupby(ISOWeekNumbers(month_group.completed_at))
 
     week_keys= list(completed_per_week.groups.keys())
     week_keys.sort()
@@ -99,7 +551,7 @@ def WeeklyRepeatingUsers(month,sorted_completed_months_keys,completed_per_month)
     month_repeated_users=MonthlyRepeatingUsers(month,sorted_completed_months_keys,completed_per_month)[1]
     month_group=completed_per_month.get_group(month)
 
-    completed_per_week=month_group.groupby([month_group.completed_at.dt.week])
+    completed_per_week=month_group.groupby(ISOWeekNumbers(month_group.completed_at))
     week_keys= list(completed_per_week.groups.keys())
     week_keys.sort()
 
@@ -112,55 +564,96 @@ def WeeklyRepeatingUsers(month,sorted_completed_months_keys,completed_per_month)
 
     return week_keys, repeated_user_per_week
 
-def CustomerLifetime(month,sorted_completed_months_keys,completed_per_month):
-
+def CustomerLifetime(month,sorted_completed_months_keys,completed_per_month,user_index=None):
+    '''
+    Returns the average number of months in which the users of the current month
+    completed an order, up to and including the current month.
+    '''
     current_month_index = sorted_completed_months_keys.index(month)
-    current_month_users = MonthlyTotalUsers(sorted_completed_months_keys[current_month_index],completed_per_month)[1]
 
+    return CustomerLifetimePerMonth(sorted_completed_months_keys,completed_per_month,user_index)[current_month_index]
 
-    user_lifetime=0
-    for user in current_month_users:
-        user_lifetime+=1
-        for month_index in range(0,current_month_index):
-            month_users = MonthlyTotalUsers(sorted_completed_months_keys[month_index],completed_per_month)[1]
-            if user in month_users:
-                user_lifetime+=1
+def CustomerLifetimePerMonth(sorted_completed_months_keys,completed_per_month,user_index=None):
+    '''
+    Returns the customer lifetime of every month in sorted_completed_months_keys, in one call.
+    Each user contributes to every month it is active in with the number of its active months so far.
+    '''
+    if user_index is None:
+        user_index=UserIndex(sorted_completed_months_keys,completed_per_month)
+
+    num_months=len(sorted_completed_months_keys)
 
-    return user_lifetime / current_month_users.shape[0]
+    # active_months holds the months of each user in order, so the position
+    # inside the user's slice is the number of months the user was active before
+    user_start=user_index.active_offsets[:-1]
+    user_num_months=np.diff(user_index.active_offsets)
+    months=user_index.active_months
+    months_so_far=np.arange(months.shape[0]) - np.repeat(user_start,user_num_months) + 1
 
+    user_lifetime=np.bincount(months,weights=months_so_far,minlength=num_months)
+    month_users=np.bincount(months,minlength=num_months)
 
-def CustomerLifetimeValue(month,sorted_completed_months_keys,completed_per_month):
+    return (user_lifetime / month_users).tolist()
 
-    cl=CustomerLifetime(month,sorted_completed_months_keys,completed_per_month)
 
+def CustomerLifetimeValue(month,sorted_completed_months_keys,completed_per_month,user_index=None):
+    '''
+    Returns the customer lifetime of the current month times the average order value
+    of all the orders completed up to the current month.
+    '''
     current_month_index = sorted_completed_months_keys.index(month)
 
-    total_num_orders=0
-    total_order_value=0.0
+    return OrderValuePerMonth(sorted_completed_months_keys,completed_per_month,user_index)[2][current_month_index]
 
-    for month_index in range(0,current_month_index+1):
-        month_group = completed_per_month.get_group(sorted_completed_months_keys[month_index])
-        total_num_orders+=month_group.shape[0]
-        total_order_value+=month_group.total.sum()
+def BasketValue(month,sorted_completed_months_keys,completed_per_month):
+    '''
+    Returns the average item total of all the orders completed up to the current month.
+    '''
+    current_month_index = sorted_completed_months_keys.index(month)
 
-    avg_order_value = total_order_value / total_num_orders
+    aggregates=MonthlyOrderAggregates(sorted_completed_months_keys,completed_per_month)
+    month_aggregates=aggregates.iloc[current_month_index]
 
-    return cl * avg_order_value
+    return month_aggregates['cumulative_item_total'] / month_aggregates['cumulative_orders']
 
-def BasketValue(month,sorted_completed_months_keys,completed_per_month):
-    current_month_index = sorted_completed_months_keys.index(month)
+def MonthlyOrderAggregates(sorted_completed_months_keys,completed_per_month):
+    '''
+    Returns a table with one row per month in sorted_completed_months_keys holding
+    the number of orders, the sum of total and item_total, and their cumulative sums.
+    '''
+    orders,positions=_MonthPositions(sorted_completed_months_keys,completed_per_month)
+    num_months=len(sorted_completed_months_keys)
+
+    return PeriodOrderAggregates(positions,orders['total'].values,orders['item_total'].values,num_months)
+
+def PeriodOrderAggregates(positions,totals,item_totals,num_periods):
+    '''
+    Returns a table with one row per period holding the number of orders,
+    the sum of total and item_total, and their cumulative sums.
+    '''
+    aggregates=pd.DataFrame({
+        'orders':np.bincount(positions,minlength=num_periods),
+        'total':np.bincount(positions,weights=totals,minlength=num_periods),
+        'item_total':np.bincount(positions,weights=item_totals,minlength=num_periods),
+    })
+
+    cumulative=aggregates.cumsum().add_prefix('cumulative_')
 
-    total_num_orders=0
-    total_order_value=0.0
+    return pd.concat([aggregates,cumulative],axis=1)
 
-    for month_index in range(0,current_month_index+1):
-        month_group = completed_per_month.get_group(sorted_completed_months_keys[month_index])
-        total_num_orders+=month_group.shape[0]
-        total_order_value+=month_group.item_total.sum()
+def OrderValuePerMonth(sorted_completed_months_keys,completed_per_month,user_index=None):
+    '''
+    Returns basket value, average order value and customer lifetime value
+    of every month in sorted_completed_months_keys, in one call.
+    '''
+    aggregates=MonthlyOrderAggregates(sorted_completed_months_keys,completed_per_month)
+    customers_lifetime=CustomerLifetimePerMonth(sorted_completed_months_keys,completed_per_month,user_index)
 
-    avg_order_value = total_order_value / total_num_orders
+    basket_value=aggregates['cumulative_item_total'] / aggregates['cumulative_orders']
+    avg_order_value=aggregates['cumulative_total'] / aggregates['cumulative_orders']
+    customers_lifetime_value=np.array(customers_lifetime) * avg_order_value.values
 
-    return avg_order_value
+    return basket_value.tolist(),avg_order_value.tolist(),customers_lifetime_value.tolist()
 
 ##############################
 ##############################
@@ -258,53 +751,84 @@ def cell_style(value, min_value, max_value):
     return style
 
 
-def ConditionalTable(dataframe):
+CELL_STYLE = {
+    'height': '100%',
+    'border-style': 'solid hidden solid hidden',
+    'border-width': '0.4px',
+    'text-align': 'center',
+    'vertical-align': 'middle',
+}
+
+# one style per color, shared by all the cells of that color
+CELL_STYLES = [dict(CELL_STYLE, **{'backgroundColor': color['background'], 'color': color['text']}) for color in COLORS]
+
+
+def ColorIndexes(dataframe,has_last_row=True):
+    '''
+    Returns the index in COLORS of every cell of the table, computed for the whole table at once
+    with the same rules as cell_style: the first two columns, the last row and the non numeric cells
+    get the first color, the other cells are scaled between the min and max of their row.
+    Colors only depend on the row, so dataframe can be a slice of rows of the table;
+    has_last_row tells whether it holds the last row of the table.
+    '''
+    numeric=dataframe.apply(pd.to_numeric,errors='coerce').values.astype(float)
+    color_index=np.zeros(numeric.shape,dtype=int)
+
+    num_rows=numeric.shape[0] - 1 if has_last_row else numeric.shape[0]
+    if num_rows < 1 or numeric.shape[1] < 3:
+        return color_index
+
+    values=numeric[:num_rows,2:]
+    with warnings.catch_warnings(), np.errstate(divide='ignore',invalid='ignore'):
+        # rows without any value are all NaN
+        warnings.simplefilter('ignore',RuntimeWarning)
+        min_value=np.nanmin(values,axis=1)[:,None]
+        max_value=np.nanmax(values,axis=1)[:,None]
+
+        scaled=(values - min_value) / (max_value - min_value)
+        # the row min gets a light color unless it is zero
+        scaled=np.where((values != 0.0) & (values == min_value),0.1,scaled)
+        flat=np.where((max_value == 0.0) & (min_value == 0.0),0.0,1.0)
+        relative_value=np.where(max_value > min_value,scaled,flat)
+
+        row_index=np.rint(relative_value * 10)
+        row_index=np.where(np.isnan(values),0,row_index)
+
+    color_index[:num_rows,2:]=np.minimum(row_index,len(COLORS)-1).astype(int)
+    return color_index
+
+
+def PageCount(dataframe,page_size):
+    '''
+    Returns the number of pages of page_size rows of a table, at least one.
+    '''
+    return max(1,-(-len(dataframe) // page_size))
+
+
+def ConditionalTable(dataframe,start=0,stop=None):
+    '''
+    Returns the rows of a DataTable with every cell colored according to its value
+    relative to the other values of its row. Only the rows from start to stop are converted
+    and built, colored as in the whole table.
+    '''
+    # imported here so that computing the metrics never pays for dash
+    import dash_html_components as html
+
+    page=dataframe.iloc[start:stop]
+    has_last_row=start + len(page) == len(dataframe)
+    color_index=ColorIndexes(page,has_last_row)
+    columns=list(dataframe.columns)
+    last_row=len(page)-1 if has_last_row else None
 
     rows = []
-    for i in range(0,len(dataframe)):
-        if i != (len(dataframe)-1):
-            max_value = np.nanmax(dataframe.iloc[i][2:].values)
-            min_value = np.nanmin(dataframe.iloc[i][2:].values)
-            #print('min value ',min_value)
-            #print('max value ',max_value)
-            row = {}
-            for col_index,col in enumerate(dataframe.columns):
-                value = dataframe.iloc[i][col]
-                if col_index > 1:
-                    style = cell_style(value, min_value, max_value)
-                else:
-                    style = cell_style(value, 0.0, 0.0)
-
-                if isinstance(value,float) and ~np.isnan(value):
-                    value='{:.3f}'.format(value)
-
-                row[col] = html.Div(
-                    value,
-                    style=dict({
-                        'height': '100%',
-                        'border-style': 'solid hidden solid hidden',
-                        'border-width': '0.4px',
-                        'text-align': 'center',
-                        'vertical-align': 'middle',
-                    }, **style)
-                )
-            rows.append(row)
-        else:
-            row = {}
-            for col_index,col in enumerate(dataframe.columns):
-                value = dataframe.iloc[i][col]
-                style = cell_style(value, 0.0, 0.0)
-                row[col] = html.Div(
-                        value,
-                        style=dict({
-                            'height': '100%',
-                            'border-style': 'solid hidden solid hidden',
-                            'border-width': '0.4px',
-                            'text-align': 'center',
-                            'vertical-align': 'middle',
-                        }, **style)
-                    )
-            rows.append(row)
-
-        #print('')
-    return rows
\ No newline at end of file
+    for i,values in enumerate(page.itertuples(index=False,name=None)):
+        if i != last_row:
+            values=['{:.3f}'.format(value) if isinstance(value,float) and ~np.isnan(value) else value for value in values]
+
+        rows.append({col: html.Div(value,style=CELL_STYLES[index]) for col,value,index in zip(columns,values,color_index[i])})
+
+    return rows
+
+
+# every public function is timed as a stage while profiling is enabled
+profiling.Instrument(sys.modules[__name__])
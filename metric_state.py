@@ -0,0 +1,261 @@
+import os
+import pickle
+import tempfile
+import numpy as np
+import pandas as pd
+
+import methods
+import periods
+
+DEFAULT_STATE_PATH = 'metric_state.pkl'
+
+# states saved with another version are rebuilt from scratch
+STATE_VERSION = 7
+
+
+def _AddMonth(matrix,column):
+    '''
+    Returns a [first month, month] matrix grown by one month whose cohorts are column.
+    '''
+    position=matrix.shape[0]
+    grown=np.zeros((position+1,position+1),dtype=matrix.dtype)
+    grown[:position,:position]=matrix
+    grown[:,position]=column
+    return grown
+
+
+def _OffsetLayout(matrix):
+    '''
+    Returns a [first month, month] matrix laid out like methods.CohortCounts, [first month, offset].
+    '''
+    num_months=matrix.shape[0]
+    offset_matrix=np.zeros_like(matrix)
+    for first_month in range(num_months):
+        offset_matrix[first_month,:num_months-first_month]=matrix[first_month,first_month:]
+    return offset_matrix
+
+
+class MetricState(object):
+    '''
+    Persisted state of the dashboard metrics.
+    Closed months are folded into the state once and never recomputed: their aggregates,
+    the first month and number of active months of every user seen so far, and their
+    column of the cohort matrix. Only the latest month is kept open: it is recomputed
+    from its orders on every update, and closed when a later month shows up.
+    Orders of a closed month that change afterwards are not picked up.
+    Months without orders between the first and the last one are kept as empty months,
+    like the dense periods of pipeline.PeriodMetrics.
+    '''
+
+    def __init__(self):
+        self.version=STATE_VERSION
+
+        # fingerprints of the exports folded so far, see LoadMetricState
+        self.sources=()
+
+        # closed months as (month, year), sorted
+        self.months=[]
+        self.month_rows=[]
+
+        # every user of the closed months, sorted, with the index of its first month
+        # and its number of closed months with an order
+        self.user_ids=np.zeros(0,dtype=float)
+        self.first_month=np.zeros(0,dtype='int64')
+        self.active_months=np.zeros(0,dtype='int64')
+
+        # [first month, month] -> users of the first month cohort active in month,
+        # orders they completed in month and the sum of their total
+        self.cohort_counts=np.zeros((0,0),dtype='int64')
+        self.cohort_orders=np.zeros((0,0),dtype='int64')
+        self.cohort_revenue=np.zeros((0,0),dtype=float)
+
+        self.open_month=None
+        self.open_row=None
+        self.open_cohort_columns=None
+
+    def _MonthRow(self,month_orders,position,close):
+        '''
+        Returns the aggregates and the user, order and revenue cohort columns of the month at position.
+        If close is set the users of the month are folded into the user state.
+        '''
+        # guest orders (no user_id) count in the order sums only
+        is_renewal,_=methods.SubscriptionColumns(month_orders)
+        known=month_orders['user_id'].notnull().values
+        user_orders=month_orders[known]
+        users=np.unique(user_orders['user_id'].values)
+
+        # users of the month already seen in a closed month, merged by binary search
+        seen_index=np.searchsorted(self.user_ids,users)
+        seen=seen_index < self.user_ids.shape[0]
+        seen[seen]=self.user_ids[seen_index[seen]] == users[seen]
+        first_month=np.full(users.shape[0],position,dtype='int64')
+        first_month[seen]=self.first_month[seen_index[seen]]
+        active_months=np.ones(users.shape[0],dtype='int64')
+        active_months[seen]+=self.active_months[seen_index[seen]]
+        new_users=int((first_month == position).sum())
+
+        # repeating users with at least one order of the month that is not a renewal
+        organic=np.isin(users,user_orders['user_id'].values[~is_renewal[known]])
+        organic_repeating_users=int((organic & (first_month != position)).sum())
+
+        row={
+            'orders':int(month_orders.shape[0]),
+            'total':month_orders['total'].sum(),
+            'item_total':month_orders['item_total'].sum(),
+            'total_users':int(users.shape[0]),
+            'new_users':new_users,
+            'repeating_users':int(users.shape[0]) - new_users,
+            'lifetime_sum':int(active_months.sum()),
+            'organic_repeating_users':organic_repeating_users,
+            'renewal_users':int(users.shape[0]) - new_users - organic_repeating_users,
+            'renewal_orders':int(is_renewal.sum()),
+        }
+        order_first_month=first_month[np.searchsorted(users,user_orders['user_id'].values)]
+        cohort_columns=(
+            np.bincount(first_month,minlength=position+1),
+            np.bincount(order_first_month,minlength=position+1),
+            np.bincount(order_first_month,weights=user_orders['total'].values,minlength=position+1),
+        )
+
+        if close:
+            self.active_months[seen_index[seen]]=active_months[seen]
+            # the new users are inserted at their sorted position
+            new_index=seen_index[~seen]
+            self.user_ids=np.insert(self.user_ids,new_index,users[~seen])
+            self.first_month=np.insert(self.first_month,new_index,first_month[~seen])
+            self.active_months=np.insert(self.active_months,new_index,active_months[~seen])
+
+        return row,cohort_columns
+
+    def Update(self,order,sources=None):
+        '''
+        Folds completed orders into the state.
+        Orders of closed months are skipped, every later month but the latest is closed,
+        and the latest month is recomputed as the open month.
+        sources are the fingerprints of the exports the orders come from.
+        '''
+        if sources is not None:
+            self.sources=tuple(sources)
+
+        month_codes=periods.PeriodCodes(order['completed_at'],'Month')
+        if self.months:
+            last_closed_code=periods.MonthCode(*self.months[-1])
+            recent=month_codes > last_closed_code
+            order=order[recent]
+            month_codes=month_codes[recent]
+
+        self.open_month=None
+        self.open_row=None
+        self.open_cohort_columns=None
+
+        month_groups=order.groupby(month_codes)
+        if not month_groups.groups:
+            return
+        last_code=max(month_groups.groups.keys())
+        first_code=last_closed_code + 1 if self.months else min(month_groups.groups.keys())
+        codes=range(first_code,last_code+1)
+
+        for index,code in enumerate(codes):
+            month=periods.MonthYear(code)
+            position=len(self.months)
+            close = index < len(codes)-1
+
+            month_orders=month_groups.get_group(code) if code in month_groups.groups else order.iloc[:0]
+            row,cohort_columns=self._MonthRow(month_orders,position,close)
+
+            if close:
+                self.months.append(month)
+                self.month_rows.append(row)
+
+                self.cohort_counts=_AddMonth(self.cohort_counts,cohort_columns[0])
+                self.cohort_orders=_AddMonth(self.cohort_orders,cohort_columns[1])
+                self.cohort_revenue=_AddMonth(self.cohort_revenue,cohort_columns[2])
+            else:
+                self.open_month=month
+                self.open_row=row
+                self.open_cohort_columns=cohort_columns
+
+    def Months(self):
+        '''
+        Returns every month of the state, closed and open, as (month, year), without gaps.
+        '''
+        if self.open_month is None:
+            return list(self.months)
+        return self.months + [self.open_month]
+
+    def MonthlyTable(self):
+        '''
+        Returns one row per month with the aggregates and the dashboard metrics:
+        total, new and repeating users (organic or renewing), renewal orders,
+        customer lifetime, basket value and customer lifetime value.
+        '''
+        rows=list(self.month_rows)
+        if self.open_row is not None:
+            rows.append(self.open_row)
+
+        table=pd.DataFrame(rows,columns=['orders','total','item_total','total_users','new_users','repeating_users','lifetime_sum',
+                                         'organic_repeating_users','renewal_users','renewal_orders'])
+
+        cumulative_orders=table['orders'].cumsum()
+        table['customers_lifetime']=table['lifetime_sum'] / table['total_users']
+        table['basket_value']=table['item_total'].cumsum() / cumulative_orders
+        table['customers_lifetime_value']=table['customers_lifetime'] * (table['total'].cumsum() / cumulative_orders)
+
+        return table
+
+    def CohortMatrices(self):
+        '''
+        Returns the user, order count and revenue cohort matrices laid out like methods.CohortMatrices:
+        entry [i,k] is about the users of cohort i k months later.
+        '''
+        matrices=[self.cohort_counts,self.cohort_orders,self.cohort_revenue]
+        if self.open_cohort_columns is not None:
+            matrices=[_AddMonth(matrix,column) for matrix,column in zip(matrices,self.open_cohort_columns)]
+
+        return tuple(_OffsetLayout(matrix) for matrix in matrices)
+
+    def CohortCounts(self):
+        '''
+        Returns the user cohort matrix laid out like methods.CohortCounts.
+        '''
+        return self.CohortMatrices()[0]
+
+    def CohortTables(self):
+        '''
+        Returns the user cohort tables with absolute and percentage values and the
+        order count and revenue cohort tables, as methods.CohortTablesFromMatrices.
+        '''
+        return methods.CohortTablesFromMatrices(self.Months(),*self.CohortMatrices())
+
+    def Save(self,path=DEFAULT_STATE_PATH):
+        # every writer has its own temporary file, concurrent saves never mix their content
+        directory,name=os.path.split(os.path.abspath(path))
+        descriptor,temporary_path=tempfile.mkstemp(prefix=name+'.',suffix='.tmp',dir=directory)
+        try:
+            with os.fdopen(descriptor,'wb') as state_file:
+                pickle.dump(self,state_file,protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path,path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+
+def LoadMetricState(path=DEFAULT_STATE_PATH,sources=None):
+    '''
+    Returns the state saved at path, or an empty state if there is none.
+    If sources is given (fingerprints of the current exports, e.g. their path, size and mtime),
+    a state folded from an export that changed or disappeared since is rebuilt;
+    new exports are folded into the saved state.
+    '''
+    if not os.path.exists(path):
+        return MetricState()
+
+    with open(path,'rb') as state_file:
+        state=pickle.load(state_file)
+
+    if getattr(state,'version',1) != STATE_VERSION:
+        return MetricState()
+    if sources is not None and not set(state.sources) <= set(sources):
+        return MetricState()
+    return state
@@ -0,0 +1,218 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+import methods
+import order_store
+import pipeline
+
+##############################
+# Precomputed dashboard metrics shared by every worker of the server.
+# A precompute step writes the series, the cohort matrices and the user activity
+# as .npy files into a new version directory, then points CURRENT at it with an atomic rename.
+# Workers map the arrays read-only (the pages are shared through the OS page cache, not copied
+# into every worker) and attach to the new version on the first call after CURRENT changes.
+##############################
+
+DEFAULT_STORE_DIR = 'metric_store'
+
+EXPORT_PATTERN = 'query_result_*.csv'
+
+DEFAULT_START_YEAR = 2018
+
+STORE_FORMAT = 1
+
+# versions kept on disk: the current one and the previous ones, still mapped by workers that did not switch yet
+KEEP_VERSIONS = 3
+
+MATRICES = ['cohort_users','cohort_orders','cohort_revenue']
+
+# distinct (user, month) pairs sorted by user then month
+ACTIVITY = ['activity_users','activity_periods']
+
+# tables stored column by column, the first column (the period names) in the manifest
+FRAMES = ['survival_df']
+
+
+def _SaveFrame(directory,name,frame):
+    columns=[]
+    for index,column in enumerate(frame.columns[1:]):
+        path='{}.{}.npy'.format(name,index)
+        np.save(os.path.join(directory,path),pd.to_numeric(frame[column]).values)
+        columns.append({'name':column,'path':path})
+    return {'period_column':frame.columns[0],'names':frame[frame.columns[0]].tolist(),'columns':columns}
+
+
+def _LoadFrame(directory,layout):
+    frame=pd.DataFrame({layout['period_column']:layout['names']})
+    for column in layout['columns']:
+        frame[column['name']]=np.load(os.path.join(directory,column['path']),mmap_mode='r')
+    # the tables of the dashboard hold python values, like the ones of the pipeline
+    return frame.astype(object)
+
+
+def Activity(user_ids,positions):
+    '''
+    Returns the distinct (user, period) pairs of the orders, sorted by user then period.
+    Orders without a user are left out.
+    '''
+    activity=pd.DataFrame({'user_id':user_ids,'period':positions}).dropna().drop_duplicates()
+    activity=activity.sort_values(['user_id','period'])
+    return activity['user_id'].values.astype('int64'),activity['period'].values.astype('int32')
+
+
+def WriteMetricStore(order,store_dir=DEFAULT_STORE_DIR):
+    '''
+    Computes the monthly dashboard metrics of the completed orders and publishes them
+    as a new version of the store. Returns the name of the version.
+    '''
+    # the cohort matrices and the months of the published tables, not computed twice
+    metrics,months,matrices=pipeline.PeriodMetricsWithMatrices(order,'Month')
+    arrays=dict(zip(MATRICES,matrices))
+    arrays.update(zip(ACTIVITY,Activity(months.UserIds(),months.positions)))
+    series=pipeline.MetricSeries(metrics)
+    for metric in series:
+        arrays[metric]=np.asarray(metrics[metric])
+
+    versions_dir=os.path.join(store_dir,'versions')
+    os.makedirs(versions_dir,exist_ok=True)
+    # names sort in publication order
+    now=time.time()
+    version='{}{:06d}-{}'.format(time.strftime('%Y%m%dT%H%M%S',time.gmtime(now)),int(now % 1 * 1e6),os.getpid())
+    temporary_dir=os.path.join(versions_dir,'.'+version)
+    os.makedirs(temporary_dir)
+
+    for name,values in arrays.items():
+        np.save(os.path.join(temporary_dir,name+'.npy'),values)
+
+    manifest={
+        'format':STORE_FORMAT,
+        'version':version,
+        'first_month':months.first_code,
+        'period_names':metrics['period_names'],
+        'cohort_names':months.CohortNames(),
+        'series':series,
+        'frames':{name:_SaveFrame(temporary_dir,name,metrics[name]) for name in FRAMES if name in metrics},
+    }
+    with open(os.path.join(temporary_dir,'manifest.json'),'w') as manifest_file:
+        json.dump(manifest,manifest_file,indent=2)
+
+    # the version directory is complete before CURRENT names it, readers never see a partial version
+    os.rename(temporary_dir,os.path.join(versions_dir,version))
+    temporary_path=os.path.join(store_dir,'CURRENT.{}'.format(os.getpid()))
+    with open(temporary_path,'w') as current_file:
+        current_file.write(version)
+    os.replace(temporary_path,os.path.join(store_dir,'CURRENT'))
+
+    for old_version in sorted(os.listdir(versions_dir))[:-KEEP_VERSIONS]:
+        if old_version != version and not old_version.startswith('.'):
+            shutil.rmtree(os.path.join(versions_dir,old_version),ignore_errors=True)
+
+    return version
+
+
+class MetricStore(object):
+    '''
+    Read-only view of the current version of a metric store.
+    Arrays are memory-mapped; the tables built from them are kept until the version changes.
+    '''
+
+    def __init__(self,store_dir=DEFAULT_STORE_DIR):
+        self.store_dir=store_dir
+        self.version=None
+        self.manifest=None
+        self.arrays={}
+        self.frames={}
+        self.metrics=None
+        self.lock=threading.RLock()
+
+    def Version(self):
+        '''
+        Returns the name of the current version, or None if nothing was published yet.
+        '''
+        try:
+            with open(os.path.join(self.store_dir,'CURRENT')) as current_file:
+                return current_file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _Attach(self):
+        version=self.Version()
+        if version is None:
+            raise RuntimeError('no metrics published in {}, run metric_store.py first'.format(self.store_dir))
+        if version == self.version:
+            return
+
+        directory=os.path.join(self.store_dir,'versions',version)
+        with open(os.path.join(directory,'manifest.json')) as manifest_file:
+            manifest=json.load(manifest_file)
+        if manifest['format'] != STORE_FORMAT:
+            raise RuntimeError('metric store format {} is not supported'.format(manifest['format']))
+
+        names=MATRICES + ACTIVITY + manifest['series']
+        self.arrays={name:np.load(os.path.join(directory,name+'.npy'),mmap_mode='r') for name in names}
+        self.frames={name:_LoadFrame(directory,layout) for name,layout in manifest['frames'].items()}
+        self.manifest=manifest
+        self.version=version
+        self.metrics=None
+
+    def Array(self,name):
+        '''
+        Returns a memory-mapped array of the current version.
+        '''
+        with self.lock:
+            self._Attach()
+            return self.arrays[name]
+
+    def Activity(self):
+        '''
+        Returns the user and month position of every distinct (user, month) pair, sorted by user then month,
+        and the names of the months.
+        '''
+        with self.lock:
+            self._Attach()
+            return self.arrays['activity_users'],self.arrays['activity_periods'],self.manifest['period_names']
+
+    def Metrics(self):
+        '''
+        Returns the dashboard series and tables, laid out like the result of pipeline.MonthlyMetrics.
+        '''
+        with self.lock:
+            self._Attach()
+            if self.metrics is None:
+                metrics={'granularity':'Month','period_names':self.manifest['period_names']}
+                for metric in self.manifest['series']:
+                    metrics[metric]=self.arrays[metric].tolist()
+                cohort_tables=methods.PeriodCohortTables(self.manifest['cohort_names'],
+                                                         *[self.arrays[name] for name in MATRICES],period_column='Month')
+                metrics.update(zip(pipeline.COHORT_TABLES,cohort_tables))
+                metrics.update(self.frames)
+                self.metrics=metrics
+            return self.metrics
+
+
+def Main(argv=None):
+    parser=argparse.ArgumentParser(description='Precomputes the dashboard metrics of the Spree order exports into a shared metric store.')
+    parser.add_argument('--pattern',default=EXPORT_PATTERN,help='exports merged into the order store')
+    parser.add_argument('--store-dir',default=DEFAULT_STORE_DIR)
+    parser.add_argument('--start-year',type=int,default=DEFAULT_START_YEAR)
+    arguments=parser.parse_args(argv)
+
+    store=order_store.OrderStore()
+    store.IngestAll(arguments.pattern)
+    order=store.Orders()
+    order=order[order.state=='complete']
+    order=order[order.completed_at.dt.year>=arguments.start_year]
+
+    print(WriteMetricStore(order,arguments.store_dir))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -0,0 +1,226 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+import loader
+
+# columns kept in the store: the ones used by the dashboard plus the version and segment columns
+STORE_COLUMNS = loader.DEFAULT_COLUMNS + ['updated_at','payment_state','shipment_state','channel','currency','store_id']
+
+DEFAULT_STORE_DIR = 'order_store'
+
+# number of part files after which the store is rewritten as a single part
+MAX_PARTS = 16
+
+
+def FileHash(path):
+    '''
+    Returns the sha1 of the content of a file.
+    '''
+    sha1=hashlib.sha1()
+    with open(path,'rb') as source:
+        for block in iter(lambda: source.read(1 << 20),b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class _StoreLock(object):
+    '''
+    Lock file of a store, shared by the readers and exclusive to the writer.
+    '''
+
+    def __init__(self,path,exclusive):
+        self.path=path
+        self.exclusive=exclusive
+
+    def __enter__(self):
+        self.lock_file=open(self.path,'a')
+        fcntl.flock(self.lock_file,fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self,*exc_info):
+        fcntl.flock(self.lock_file,fcntl.LOCK_UN)
+        self.lock_file.close()
+        return False
+
+
+class OrderStore(object):
+    '''
+    Append-only store of the orders of all the query_result exports.
+    Every export re-exports the full history, so ingesting it only appends the
+    orders that are new or whose updated_at is later than the stored version.
+    Orders are keyed on id; reading the store keeps the latest version of each order.
+    Several processes (the dashboard workers) can share a store: ingest, compact and clear
+    hold an exclusive lock and start from the manifest on disk, reads hold a shared lock.
+    '''
+
+    def __init__(self,store_dir=DEFAULT_STORE_DIR,columns=STORE_COLUMNS):
+        self.store_dir=store_dir
+        self.columns=list(columns)
+        self.manifest_path=os.path.join(store_dir,'manifest.json')
+        self.lock_path=os.path.join(store_dir,'lock')
+
+        os.makedirs(store_dir,exist_ok=True)
+        with _StoreLock(self.lock_path,exclusive=True):
+            self.manifest=self._ReadManifest()
+
+            # a store written with other columns can not be appended to
+            if self.manifest['columns'] != self.columns:
+                self._Clear()
+
+    def _ReadManifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        return {'columns':self.columns,'exports':{},'parts':[]}
+
+    def _WriteManifest(self):
+        descriptor,temporary_path=tempfile.mkstemp(prefix='manifest.',suffix='.tmp',dir=self.store_dir)
+        try:
+            with os.fdopen(descriptor,'w') as manifest_file:
+                json.dump(self.manifest,manifest_file,indent=2,sort_keys=True)
+            os.replace(temporary_path,self.manifest_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def _PartPath(self,part):
+        return os.path.join(self.store_dir,part)
+
+    def Clear(self):
+        '''
+        Removes every stored order.
+        '''
+        with _StoreLock(self.lock_path,exclusive=True):
+            self.manifest=self._ReadManifest()
+            self._Clear()
+
+    def _Clear(self):
+        for part in self.manifest['parts']:
+            if os.path.exists(self._PartPath(part)):
+                os.remove(self._PartPath(part))
+        self.manifest={'columns':self.columns,'exports':{},'parts':[]}
+        self._WriteManifest()
+
+    def _Conform(self,order):
+        '''
+        Reconciles the schema of an export with the schema of the store:
+        missing columns are added empty and extra columns are dropped.
+        '''
+        for column in self.columns:
+            if column not in order.columns:
+                order[column]=np.nan
+        order=order[self.columns]
+
+        for column,dtype in loader.ORDER_DTYPES.items():
+            if column in order.columns:
+                order[column]=order[column].astype(dtype)
+        for column in loader.DATE_COLUMNS:
+            if column in order.columns:
+                order[column]=pd.to_datetime(order[column])
+
+        return order
+
+    def _Versions(self):
+        '''
+        Returns the latest stored updated_at of every order id.
+        '''
+        if not self.manifest['parts']:
+            return pd.Series([],dtype='datetime64[ns]',index=pd.Index([],dtype='int64',name='id'),name='updated_at')
+
+        versions=pd.concat([loader.ReadFrame(self._PartPath(part),columns=['id','updated_at'])
+                            for part in self.manifest['parts']],ignore_index=True)
+        return versions.groupby('id')['updated_at'].max()
+
+    def Ingest(self,path):
+        '''
+        Appends the new and changed orders of an export to the store.
+        Returns the number of appended orders; an export that was already ingested is skipped.
+        '''
+        export_hash=FileHash(path)
+        with _StoreLock(self.lock_path,exclusive=True):
+            # another process may have ingested since the manifest was read
+            self.manifest=self._ReadManifest()
+            if export_hash in self.manifest['exports']:
+                return 0
+            return self._Ingest(path,export_hash)
+
+    def _Ingest(self,path,export_hash):
+        order=self._Conform(loader.ReadOrdersCsv(path,self.columns))
+
+        stored_updated_at=self._Versions().reindex(order['id'].values)
+        changed=stored_updated_at.isnull().values | (order['updated_at'].values > stored_updated_at.values)
+        delta=order[changed]
+
+        part=None
+        if delta.shape[0] > 0:
+            part='part-{:05d}-{}{}'.format(len(self.manifest['exports']),export_hash[:8],loader.CACHE_EXTENSION)
+            loader.WriteFrame(delta.reset_index(drop=True),self._PartPath(part))
+            self.manifest['parts'].append(part)
+
+        self.manifest['exports'][export_hash]={
+            'path':os.path.abspath(path),
+            'rows':int(order.shape[0]),
+            'appended':int(delta.shape[0]),
+            'part':part,
+        }
+        self._WriteManifest()
+
+        if len(self.manifest['parts']) > MAX_PARTS:
+            self._Compact()
+
+        return delta.shape[0]
+
+    def IngestAll(self,pattern='query_result_*.csv'):
+        '''
+        Ingests every export matching pattern, oldest file name first.
+        Returns the total number of appended orders.
+        '''
+        return sum(self.Ingest(path) for path in sorted(glob.glob(pattern)))
+
+    def Orders(self):
+        '''
+        Returns the latest version of every stored order.
+        '''
+        # parts are only removed under the exclusive lock, after a new manifest no longer lists them
+        with _StoreLock(self.lock_path,exclusive=False):
+            self.manifest=self._ReadManifest()
+            return self._Orders()
+
+    def _Orders(self):
+        if not self.manifest['parts']:
+            return self._Conform(pd.DataFrame(columns=self.columns))
+
+        order=pd.concat([loader.ReadFrame(self._PartPath(part)) for part in self.manifest['parts']],ignore_index=True)
+        order=order.sort_values('updated_at',kind='mergesort').drop_duplicates('id',keep='last')
+        order=order.sort_values('id').reset_index(drop=True)
+
+        # parts may disagree on the categories, which turns the columns into object
+        return self._Conform(order)
+
+    def Compact(self):
+        '''
+        Rewrites the store as a single part holding only the latest version of every order.
+        '''
+        with _StoreLock(self.lock_path,exclusive=True):
+            self.manifest=self._ReadManifest()
+            self._Compact()
+
+    def _Compact(self):
+        order=self._Orders()
+        old_parts=self.manifest['parts']
+
+        part='part-{:05d}-compact{}'.format(len(self.manifest['exports']),loader.CACHE_EXTENSION)
+        loader.WriteFrame(order,self._PartPath(part))
+        self.manifest['parts']=[part]
+        self._WriteManifest()
+
+        for old_part in old_parts:
+            if old_part != part and os.path.exists(self._PartPath(old_part)):
+                os.remove(self._PartPath(old_part))
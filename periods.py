@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+
+##############################
+# Integer period codes.
+# Every timestamp is mapped once to the number of periods since the epoch
+# (days since 1970-01-01, ISO weeks since Monday 1970-01-05, months since 1970-01,
+# quarters since 1970-Q1), so that consecutive periods have consecutive codes.
+# Metrics then index dense arrays by code - first code instead of grouping by tuples.
+##############################
+
+GRANULARITIES = ['Day','Week','Month','Quarter']
+
+FIRST_MONDAY = np.datetime64('1970-01-05','D')
+
+# x axis title of every granularity
+TIME_FORMATS = {
+    'Day':'yyyy-mm-dd',
+    'Week':'yyyy-Www',
+    'Month':'mm/yyyy',
+    'Quarter':'yyyy-Qq',
+}
+
+
+def PeriodCodes(timestamps,granularity='Month'):
+    '''
+    Returns the period code of every timestamp (a datetime Series, Index or datetime64 array).
+    '''
+    values=np.asarray(timestamps,dtype='datetime64[ns]')
+
+    if granularity == 'Day':
+        return values.astype('datetime64[D]').astype('int64')
+    if granularity == 'Week':
+        return (values.astype('datetime64[D]') - FIRST_MONDAY).astype('int64') // 7
+    if granularity == 'Month':
+        return values.astype('datetime64[M]').astype('int64')
+    if granularity == 'Quarter':
+        return values.astype('datetime64[M]').astype('int64') // 3
+
+    raise ValueError('unknown granularity {!r}, expected one of {}'.format(granularity,GRANULARITIES))
+
+
+def MonthCode(month,year):
+    '''
+    Returns the month period code of (month, year), as PeriodCodes.
+    '''
+    return (year - 1970)*12 + month - 1
+
+
+def MonthYear(code):
+    '''
+    Returns the (month, year) of a month period code.
+    '''
+    return int(code % 12) + 1,int(code // 12) + 1970
+
+
+def PeriodStarts(codes,granularity='Month'):
+    '''
+    Returns the first day of every period code, as datetime64[D].
+    '''
+    codes=np.asarray(codes,dtype='int64')
+
+    if granularity == 'Day':
+        return codes.astype('datetime64[D]')
+    if granularity == 'Week':
+        return FIRST_MONDAY + codes*7
+    if granularity == 'Month':
+        return codes.astype('datetime64[M]').astype('datetime64[D]')
+    if granularity == 'Quarter':
+        return (codes*3).astype('datetime64[M]').astype('datetime64[D]')
+
+    raise ValueError('unknown granularity {!r}, expected one of {}'.format(granularity,GRANULARITIES))
+
+
+def PeriodNames(codes,granularity='Month'):
+    '''
+    Returns the name of every period code: 2018-01-05, 2018-W01, 01/2018 or 2018-Q1.
+    '''
+    starts=pd.DatetimeIndex(PeriodStarts(codes,granularity))
+
+    if granularity == 'Day':
+        return [start.strftime('%Y-%m-%d') for start in starts]
+    if granularity == 'Week':
+        # the ISO year of a week is the year of its Thursday
+        thursdays=starts + pd.Timedelta(days=3)
+        iso_weeks=(thursdays.dayofyear - 1) // 7 + 1
+        return ['{}-W{:02d}'.format(year,week) for year,week in zip(thursdays.year,iso_weeks)]
+    if granularity == 'Month':
+        return ['{:02d}/{}'.format(month,year) for month,year in zip(starts.month,starts.year)]
+    return ['{}-Q{}'.format(year,(month - 1) // 3 + 1) for month,year in zip(starts.month,starts.year)]
+
+
+class Periods(object):
+    '''
+    Completed orders mapped once to contiguous period positions at a granularity.
+    Position 0 is the period of start (or of the first order), the last position the period
+    of the last order; periods without orders in between are kept, so positions index
+    dense arrays of num_periods entries. Orders before start are dropped.
+    '''
+
+    def __init__(self,order,granularity='Month',start=None):
+        codes=PeriodCodes(order['completed_at'],granularity)
+
+        if start is not None:
+            first_code=int(PeriodCodes(np.array([pd.Timestamp(start).to_datetime64()]),granularity)[0])
+            kept=codes >= first_code
+            order=order[kept]
+            codes=codes[kept]
+        elif codes.shape[0]:
+            first_code=int(codes.min())
+        else:
+            first_code=0
+
+        self.granularity=granularity
+        self.orders=order
+        self.first_code=first_code
+        self.positions=codes - first_code
+        self.num_periods=int(self.positions.max()) + 1 if self.positions.shape[0] else 0
+
+    def Codes(self):
+        return np.arange(self.first_code,self.first_code + self.num_periods)
+
+    def Names(self):
+        return PeriodNames(self.Codes(),self.granularity)
+
+    def CohortNames(self):
+        '''
+        Returns the names of the cohort table rows; months keep the month-year names of the dashboard.
+        '''
+        if self.granularity == 'Month':
+            starts=pd.DatetimeIndex(PeriodStarts(self.Codes(),'Month'))
+            return ['{}-{}'.format(month,year) for month,year in zip(starts.month,starts.year)]
+        return self.Names()
+
+    def UserIds(self):
+        return self.orders['user_id'].values
+
+    def Column(self,column):
+        return self.orders[column].values
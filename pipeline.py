@@ -0,0 +1,228 @@
+import operator
+import numpy as np
+import pandas as pd
+
+import hyperloglog
+import methods
+import periods
+import profiling
+
+GRANULARITIES = ['Month','Week','Quarter','Day']
+
+
+def GroupByMonth(order):
+    '''
+    Returns the completed orders grouped by (month, year) and the sorted (month, year) keys,
+    the arguments of the per-month functions of methods.
+    The keys only hold months with orders, the per-month functions count months in the keys;
+    PeriodMetrics and the other engines keep the months without orders.
+    '''
+    with profiling.Stage('pipeline.groupby'):
+        completed_per_month=order.groupby([order.completed_at.dt.month,order.completed_at.dt.year])
+
+        sorted_completed_months_keys = list(completed_per_month.groups.keys())
+        sorted_completed_months_keys.sort(key=operator.itemgetter(1,0))
+
+    return sorted_completed_months_keys,completed_per_month
+
+
+def PeriodMetrics(order,granularity='Month',start=None):
+    '''
+    Returns every series and cohort table of the completed orders since start, with the users
+    and the cohorts at granularity. Customer lifetime, basket value and customer lifetime value
+    are defined on months and stay monthly.
+    Orders are mapped once to period positions and every metric indexes dense arrays by them.
+    '''
+    return PeriodMetricsWithMatrices(order,granularity,start)[0]
+
+
+def PeriodMetricsWithMatrices(order,granularity='Month',start=None):
+    '''
+    Returns the metrics of PeriodMetrics, the periods.Periods of granularity they were computed on
+    and the user, order count and revenue cohort matrices behind their cohort tables.
+    '''
+    with profiling.Stage('pipeline.periods'):
+        months=periods.Periods(order,'Month',start)
+        period_set=months if granularity == 'Month' else periods.Periods(order,granularity,start)
+        user_ids=period_set.UserIds()
+        is_renewal,recurring_count=methods.SubscriptionColumns(period_set.orders)
+
+    # repeating users are split into organic repeats and renewals in the same pass
+    with profiling.Stage('pipeline.users'):
+        total_users,new_users,repeating_users,organic_repeating_users,renewal_users=methods.PeriodRenewalUsers(
+            user_ids,period_set.positions,is_renewal,period_set.num_periods)
+        renewal_orders=np.bincount(period_set.positions[is_renewal],minlength=period_set.num_periods)
+
+    with profiling.Stage('pipeline.order_values'):
+        customers_lifetime=methods.PeriodLifetime(months.UserIds(),months.positions,months.num_periods)
+        aggregates=methods.PeriodOrderAggregates(months.positions,months.Column('total'),months.Column('item_total'),months.num_periods)
+        basket_value=aggregates['cumulative_item_total'] / aggregates['cumulative_orders']
+        avg_order_value=aggregates['cumulative_total'] / aggregates['cumulative_orders']
+
+    # user, order count and revenue cohorts come from the same grouped pass
+    with profiling.Stage('pipeline.cohort_tables'):
+        users,orders,revenue=methods.PeriodCohortMatrices(user_ids,period_set.positions,period_set.Column('total'),period_set.num_periods)
+        cohort_tables=methods.PeriodCohortTables(period_set.CohortNames(),users,orders,revenue,granularity)
+        survival_df=methods.SubscriptionSurvival(user_ids,period_set.positions,is_renewal,recurring_count,
+                                                 period_set.CohortNames(),granularity)
+
+    metrics={
+        'granularity':granularity,
+        'period_names':period_set.Names(),
+        'total_users':total_users.tolist(),
+        'new_users':new_users.tolist(),
+        'repeating_users':repeating_users.tolist(),
+        'customers_lifetime':customers_lifetime.tolist(),
+        'basket_value':basket_value.tolist(),
+        'customers_lifetime_value':(customers_lifetime * avg_order_value.values).tolist(),
+        'organic_repeating_users':organic_repeating_users.tolist(),
+        'renewal_users':renewal_users.tolist(),
+        'renewal_orders':renewal_orders.tolist(),
+        'survival_df':survival_df,
+    }
+    if granularity != 'Month':
+        metrics['month_names']=months.Names()
+    metrics.update(zip(COHORT_TABLES,cohort_tables))
+    return metrics,period_set,(users,orders,revenue)
+
+
+def MonthlyMetrics(order,start=None):
+    '''
+    Returns every month based series and cohort table of the completed orders.
+    '''
+    return PeriodMetrics(order,'Month',start)
+
+
+def WeeklyMetrics(order,start=None):
+    '''
+    Returns the week based user series and cohort tables of the completed orders,
+    with the monthly lifetime and value series.
+    '''
+    return PeriodMetrics(order,'Week',start)
+
+
+def ApproximateMetrics(order,granularity='Month',precision=hyperloglog.DEFAULT_PRECISION,start=None):
+    '''
+    Returns the dashboard metrics with every distinct user count read from per-period
+    HyperLogLog sketches instead of user sets, so memory does not grow with the users.
+    Order counts and values are exact. Order count and revenue cohort tables need the
+    first period of every user and are left empty.
+    The 'approximate' entry documents the error: counts read from one sketch (total users)
+    have relative_standard_error. New, repeating and cohort counts are differences of counts
+    of up to seen_users users: their absolute standard error is about seen_users_error
+    whatever their size, so counts below a few times seen_users_error can be off by 100% or more.
+    '''
+    with profiling.Stage('pipeline.periods'):
+        months=periods.Periods(order,'Month',start)
+        period_set=months if granularity == 'Month' else periods.Periods(order,granularity,start)
+
+    with profiling.Stage('pipeline.sketches'):
+        month_sketches=hyperloglog.PeriodRegisters(months.UserIds(),months.positions,months.num_periods,precision)
+        if granularity == 'Month':
+            sketches=month_sketches
+        else:
+            sketches=hyperloglog.PeriodRegisters(period_set.UserIds(),period_set.positions,period_set.num_periods,precision)
+
+    with profiling.Stage('pipeline.users'):
+        total_users,new_users,repeating_users,seen_users=methods.ApproximatePeriodUsers(sketches)
+
+    with profiling.Stage('pipeline.order_values'):
+        customers_lifetime=methods.ApproximatePeriodLifetime(month_sketches)
+        aggregates=methods.PeriodOrderAggregates(months.positions,months.Column('total'),months.Column('item_total'),months.num_periods)
+        basket_value=aggregates['cumulative_item_total'] / aggregates['cumulative_orders']
+        avg_order_value=aggregates['cumulative_total'] / aggregates['cumulative_orders']
+
+    with profiling.Stage('pipeline.cohort_tables'):
+        abs_cohort_df,per_cohort_df=methods.ApproximateCohortTables(period_set.CohortNames(),sketches,granularity)
+
+    relative_error=hyperloglog.RelativeError(precision)
+    metrics={
+        'granularity':granularity,
+        'period_names':period_set.Names(),
+        'total_users':total_users.tolist(),
+        'new_users':new_users.tolist(),
+        'repeating_users':repeating_users.tolist(),
+        'customers_lifetime':customers_lifetime.tolist(),
+        'basket_value':basket_value.tolist(),
+        'customers_lifetime_value':(customers_lifetime * avg_order_value.values).tolist(),
+        'abs_cohort_df':abs_cohort_df,
+        'per_cohort_df':per_cohort_df,
+        'orders_cohort_df':pd.DataFrame(columns=[granularity]),
+        'revenue_cohort_df':pd.DataFrame(columns=[granularity]),
+        'approximate':{
+            'precision':precision,
+            'relative_standard_error':relative_error,
+            'seen_users':seen_users.tolist(),
+            'seen_users_error':(seen_users * relative_error).tolist(),
+        },
+    }
+    if granularity != 'Month':
+        metrics['month_names']=months.Names()
+    return metrics
+
+
+def Metrics(order,granularity='Month',approximate=False,start=None):
+    '''
+    Returns the dashboard series and cohort tables of the completed orders since start at granularity,
+    with approximate distinct user counts if approximate is set.
+    '''
+    if approximate:
+        return ApproximateMetrics(order,granularity,start=start)
+    return PeriodMetrics(order,granularity,start)
+
+
+SERIES = ['total_users','new_users','repeating_users','customers_lifetime','basket_value','customers_lifetime_value']
+
+# series defined on months also when the users are split by another granularity
+MONTHLY_SERIES = ['customers_lifetime','basket_value','customers_lifetime_value']
+
+COHORT_TABLES = ['abs_cohort_df','per_cohort_df','orders_cohort_df','revenue_cohort_df']
+
+# split of the repeating users and survival of the subscriptions, left out by the approximate mode
+RENEWAL_SERIES = ['organic_repeating_users','renewal_users','renewal_orders']
+
+RENEWAL_TABLES = ['survival_df']
+
+
+def MetricSeries(metrics):
+    '''
+    Returns the names of the series of metrics.
+    '''
+    return SERIES + [metric for metric in RENEWAL_SERIES if metric in metrics]
+
+
+def MetricTables(metrics):
+    '''
+    Returns the names of the tables of metrics.
+    '''
+    return COHORT_TABLES + [table for table in RENEWAL_TABLES if table in metrics]
+
+
+def TidyMetrics(metrics):
+    '''
+    Returns metrics as one row per value with columns metric, period, offset and value.
+    Series have no offset; cohort tables have the cohort as period and
+    the number of periods after the first one as offset (0 is the first period of the cohort,
+    the size of the cohort in the user tables); the survival table has the start period as period
+    and the number of renewals as offset (0 is the number of subscribers).
+    '''
+    rows=[]
+    for metric in MetricSeries(metrics):
+        if metric in MONTHLY_SERIES:
+            period_names=metrics.get('month_names',metrics['period_names'])
+        else:
+            period_names=metrics['period_names']
+
+        for period,value in zip(period_names,metrics[metric]):
+            rows.append((metric,period,None,value))
+
+    for table in MetricTables(metrics):
+        cohort_df=metrics[table]
+        for values in cohort_df.itertuples(index=False,name=None):
+            for offset,value in enumerate(values[1:]):
+                if not pd.isnull(value):
+                    rows.append((table[:-3],values[0],offset,value))
+
+    tidy=pd.DataFrame(rows,columns=['metric','period','offset','value'])
+    tidy['value']=tidy['value'].astype(float)
+    return tidy
@@ -0,0 +1,242 @@
+import cProfile
+import functools
+import atexit
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+##############################
+# Timing of the pipeline stages and of the methods functions.
+# Disabled by default: a disabled stage is a shared no-op context and
+# instrumented functions are only wrapped once profiling is enabled.
+# Set COHORT_PROFILE=1 to enable it at import, COHORT_PROFILE=cprofile
+# to also keep a cProfile of every stage, and COHORT_PROFILE_DUMP to the
+# path of a JSON file written at exit.
+##############################
+
+ENABLED = False
+CPROFILE = False
+TRACE_MEMORY = True
+
+_stats = {}
+_profiles = {}
+_lock = threading.Lock()
+_local = threading.local()
+_instrumented = []
+
+
+class _NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        return False
+
+
+NO_STAGE = _NoStage()
+
+
+class _Stage(object):
+
+    def __init__(self,name):
+        self.name=name
+
+    def __enter__(self):
+        stack=getattr(_local,'stack',None)
+        if stack is None:
+            stack=_local.stack=[]
+
+        self.child_peak=0
+        if TRACE_MEMORY and tracemalloc.is_tracing():
+            self.start_memory=tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc,'reset_peak'):
+                tracemalloc.reset_peak()
+        else:
+            self.start_memory=None
+
+        self.profile=None
+        if CPROFILE and not stack:
+            # cProfile can not be nested, the outermost stage holds the profile
+            self.profile=cProfile.Profile()
+            self.profile.enable()
+
+        stack.append(self)
+        self.start=time.perf_counter()
+        return self
+
+    def __exit__(self,*exc_info):
+        elapsed=time.perf_counter() - self.start
+        _local.stack.pop()
+
+        if self.profile is not None:
+            self.profile.disable()
+
+        peak=None
+        if self.start_memory is not None:
+            peak=max(tracemalloc.get_traced_memory()[1],self.child_peak)
+            if _local.stack:
+                parent=_local.stack[-1]
+                parent.child_peak=max(parent.child_peak,peak)
+
+        with _lock:
+            stats=_stats.setdefault(self.name,{'calls':0,'seconds':0.0,'max_seconds':0.0,'peak_memory_bytes':0})
+            stats['calls']+=1
+            stats['seconds']+=elapsed
+            stats['max_seconds']=max(stats['max_seconds'],elapsed)
+            if peak is not None:
+                stats['peak_memory_bytes']=max(stats['peak_memory_bytes'],peak - self.start_memory)
+
+            if self.profile is not None:
+                if self.name in _profiles:
+                    _profiles[self.name].add(self.profile)
+                else:
+                    _profiles[self.name]=pstats.Stats(self.profile)
+
+        return False
+
+
+def Stage(name):
+    '''
+    Returns a context manager recording wall time, calls and peak memory of a pipeline stage.
+    '''
+    if not ENABLED:
+        return NO_STAGE
+    return _Stage(name)
+
+
+def _Timed(name,function):
+    @functools.wraps(function)
+    def wrapper(*args,**kwargs):
+        with Stage(name):
+            return function(*args,**kwargs)
+    wrapper.__wrapped__=function
+    return wrapper
+
+
+def Instrument(module,names=None):
+    '''
+    Records every call of the public functions of module (or of names) as a stage
+    named module.function. Functions are wrapped only while profiling is enabled.
+    '''
+    if names is None:
+        names=[name for name,value in vars(module).items()
+               if callable(value) and not name.startswith('_') and getattr(value,'__module__',None) == module.__name__
+               and not isinstance(value,type)]
+
+    _instrumented.append((module,names))
+    if ENABLED:
+        _Wrap(module,names)
+
+
+def _Wrap(module,names):
+    for name in names:
+        function=getattr(module,name)
+        if not hasattr(function,'__wrapped__'):
+            setattr(module,name,_Timed('{}.{}'.format(module.__name__,name),function))
+
+
+def _Unwrap(module,names):
+    for name in names:
+        function=getattr(module,name)
+        if hasattr(function,'__wrapped__'):
+            setattr(module,name,function.__wrapped__)
+
+
+def Enable(cprofile=False,trace_memory=True):
+    '''
+    Starts recording stages; with cprofile, every outermost stage is also profiled.
+    '''
+    global ENABLED,CPROFILE,TRACE_MEMORY
+    ENABLED=True
+    CPROFILE=cprofile
+    TRACE_MEMORY=trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    for module,names in _instrumented:
+        _Wrap(module,names)
+
+
+def Disable():
+    global ENABLED
+    ENABLED=False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    for module,names in _instrumented:
+        _Unwrap(module,names)
+
+
+def Reset():
+    with _lock:
+        _stats.clear()
+        _profiles.clear()
+
+
+def Stats():
+    '''
+    Returns the recorded stages, slowest first.
+    '''
+    with _lock:
+        stats={name:dict(values) for name,values in _stats.items()}
+    return dict(sorted(stats.items(),key=lambda item: -item[1]['seconds']))
+
+
+def ProfileText(name,limit=40):
+    '''
+    Returns the cProfile of a stage as text, sorted by cumulative time, or None.
+    '''
+    with _lock:
+        profile=_profiles.get(name)
+        if profile is None:
+            return None
+
+        output=io.StringIO()
+        profile.stream=output
+        profile.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+
+def DumpJson(path):
+    '''
+    Writes the recorded stages to path as JSON.
+    '''
+    with open(path,'w') as dump_file:
+        json.dump({'enabled':ENABLED,'cprofile':CPROFILE,'stages':Stats()},dump_file,indent=2)
+
+
+def RegisterRoutes(server,path='/_profile'):
+    '''
+    Adds routes to a flask server (the server of a Dash app) answering local requests only:
+    path returns the recorded stages as JSON and path/<stage> the cProfile of a stage.
+    '''
+    import flask
+
+    def CheckLocal():
+        if flask.request.remote_addr not in ('127.0.0.1','::1'):
+            flask.abort(403)
+
+    def ProfileStats():
+        CheckLocal()
+        return flask.jsonify({'enabled':ENABLED,'cprofile':CPROFILE,'stages':Stats()})
+
+    def ProfileStage(stage):
+        CheckLocal()
+        text=ProfileText(stage)
+        if text is None:
+            flask.abort(404)
+        return flask.Response(text,mimetype='text/plain')
+
+    server.add_url_rule(path,'profile_stats',ProfileStats)
+    server.add_url_rule(path+'/<stage>','profile_stage',ProfileStage)
+
+
+if os.environ.get('COHORT_PROFILE'):
+    Enable(cprofile=os.environ['COHORT_PROFILE'] == 'cprofile')
+
+    if os.environ.get('COHORT_PROFILE_DUMP'):
+        atexit.register(DumpJson,os.environ['COHORT_PROFILE_DUMP'])
@@ -0,0 +1,193 @@
+import argparse
+import concurrent.futures
+import glob
+import json
+import math
+import os
+import sys
+
+import loader
+import pipeline
+import segments
+import streaming
+
+##############################
+# Headless entry point: computes the dashboard metrics of one or more exports
+# and writes them to files, without importing dash or plotly.
+##############################
+
+EXPORT_PATTERN = 'query_result_*.csv'
+
+FORMATS = ['json','csv','parquet']
+
+DEFAULT_OUTPUT_DIR = 'report'
+
+DEFAULT_START_YEAR = 2018
+
+
+def CompletedOrders(path,columns=loader.DEFAULT_COLUMNS,start_year=DEFAULT_START_YEAR,use_cache=True):
+    '''
+    Returns the completed orders of an export since start_year.
+    '''
+    order=loader.LoadOrders(path,columns,use_cache=use_cache)
+    order=order[order.state=='complete']
+    return order[order.completed_at.dt.year>=start_year]
+
+
+def _JsonValue(value):
+    if isinstance(value,float) and math.isnan(value):
+        return None
+    return value
+
+
+def _CohortJson(cohort_df):
+    return {
+        'columns':list(cohort_df.columns),
+        'data':[[_JsonValue(value) for value in values] for values in cohort_df.itertuples(index=False,name=None)],
+    }
+
+
+def _WriteFrame(frame,path,output_format):
+    if output_format == 'parquet':
+        frame.to_parquet(path,index=False)
+    else:
+        frame.to_csv(path,index=False)
+
+
+def WriteMetrics(metrics,output_dir,name,output_format):
+    '''
+    Writes every series and cohort table of metrics, as returned by pipeline.Metrics.
+    json writes a single name.json; csv and parquet write the series as tidy rows
+    in name-series and every cohort table as it is shown in the dashboard.
+    Returns the written paths.
+    '''
+    if output_format == 'json':
+        path=os.path.join(output_dir,name+'.json')
+        document={metric:[_JsonValue(value) for value in metrics[metric]] for metric in pipeline.MetricSeries(metrics)}
+        document['period_names']=metrics['period_names']
+        if 'month_names' in metrics:
+            document['month_names']=metrics['month_names']
+        for table in pipeline.MetricTables(metrics):
+            document[table[:-3]]=_CohortJson(metrics[table])
+        if 'approximate' in metrics:
+            document['approximate']=metrics['approximate']
+
+        with open(path,'w') as output_file:
+            json.dump(document,output_file,indent=2)
+        return [path]
+
+    extension='.'+output_format
+    tidy=pipeline.TidyMetrics(metrics)
+    paths=[os.path.join(output_dir,name+'-series'+extension)]
+    _WriteFrame(tidy[tidy.offset.isnull()].drop(columns='offset'),paths[0],output_format)
+
+    for table in pipeline.MetricTables(metrics):
+        cohort_df=metrics[table]
+        if output_format == 'parquet':
+            # parquet columns need a single type, the cells mix ints, floats and missing values
+            cohort_df=cohort_df.copy()
+            cohort_df[cohort_df.columns[1:]]=cohort_df[cohort_df.columns[1:]].astype(float)
+        paths.append(os.path.join(output_dir,name+'-'+table[:-3]+extension))
+        _WriteFrame(cohort_df,paths[-1],output_format)
+
+    return paths
+
+
+def WriteSegmentMetrics(tidy,output_dir,name,output_format):
+    '''
+    Writes the tidy metrics of every segment, as returned by segments.SegmentMetrics.
+    '''
+    path=os.path.join(output_dir,'{}-segments.{}'.format(name,output_format))
+    if output_format == 'json':
+        records=[{column:_JsonValue(value) for column,value in zip(tidy.columns,values)}
+                 for values in tidy.itertuples(index=False,name=None)]
+        with open(path,'w') as output_file:
+            json.dump(records,output_file,indent=2)
+    else:
+        _WriteFrame(tidy,path,output_format)
+    return [path]
+
+
+def ExportReport(path,output_dir,output_format,granularity='Month',segment_column=None,
+                 start_year=DEFAULT_START_YEAR,use_cache=True,jobs=1,approximate=False,chunksize=None):
+    '''
+    Computes and writes the metrics of the export at path, split by segment_column if set.
+    If chunksize is set the export is streamed chunksize rows at a time into monthly
+    aggregates (streaming.StreamOrders) instead of being loaded, so it does not need to fit
+    in memory; the streamed metrics are the monthly series and cohort tables.
+    Returns the written paths.
+    '''
+    name,_=os.path.splitext(os.path.basename(path))
+    if chunksize:
+        metrics=streaming.StreamOrders(path,chunksize,start_year).Metrics()
+        return WriteMetrics(metrics,output_dir,name,output_format)
+
+    columns=loader.DEFAULT_COLUMNS + ([segment_column] if segment_column else [])
+    order=CompletedOrders(path,columns,start_year,use_cache)
+
+    if segment_column:
+        tidy=segments.SegmentMetrics(order,segment_column,granularity,jobs,approximate)
+        return WriteSegmentMetrics(tidy,output_dir,name,output_format)
+
+    return WriteMetrics(pipeline.Metrics(order,granularity,approximate),output_dir,name,output_format)
+
+
+def _ExportWorker(arguments):
+    return ExportReport(*arguments)
+
+
+def Main(argv=None):
+    parser=argparse.ArgumentParser(description='Computes the cohort metrics of Spree order exports and writes them to files.')
+    parser.add_argument('exports',nargs='*',help='exports or glob patterns, {} by default'.format(EXPORT_PATTERN))
+    parser.add_argument('--output-dir',default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument('--format',choices=FORMATS,default='json')
+    parser.add_argument('--granularity',choices=pipeline.GRANULARITIES,default='Month')
+    parser.add_argument('--segment-column',help='also split the metrics by the values of this column')
+    parser.add_argument('--start-year',type=int,default=DEFAULT_START_YEAR)
+    parser.add_argument('--no-cache',action='store_true',help='always parse the CSV exports')
+    parser.add_argument('--approximate',action='store_true',
+                        help='count distinct users with HyperLogLog sketches; new, repeating and cohort counts '
+                             'have an absolute error (seen_users_error in the json output), small counts can be off by 100%% or more')
+    parser.add_argument('--jobs',type=int,default=1,
+                        help='exports computed concurrently, or segments of every export with --segment-column')
+    parser.add_argument('--stream',action='store_true',
+                        help='read the exports in chunks into monthly aggregates, for exports larger than memory')
+    parser.add_argument('--chunksize',type=int,default=streaming.DEFAULT_CHUNKSIZE,help='rows read at a time with --stream')
+    arguments=parser.parse_args(argv)
+
+    if arguments.format == 'parquet' and loader.CACHE_FORMAT != 'parquet':
+        parser.error('--format parquet needs pyarrow')
+    if arguments.stream and (arguments.granularity != 'Month' or arguments.segment_column or arguments.approximate):
+        parser.error('--stream computes the monthly metrics only, without --segment-column or --approximate')
+    if arguments.chunksize < 1:
+        parser.error('--chunksize must be positive')
+
+    paths=[]
+    for pattern in arguments.exports or [EXPORT_PATTERN]:
+        paths.extend(sorted(glob.glob(pattern)))
+    if not paths:
+        parser.error('no export found')
+
+    os.makedirs(arguments.output_dir,exist_ok=True)
+
+    # segments are already spread over the jobs, exports are then computed one after the other
+    export_jobs=1 if arguments.segment_column else arguments.jobs
+    tasks=[(path,arguments.output_dir,arguments.format,arguments.granularity,arguments.segment_column,
+            arguments.start_year,not arguments.no_cache,arguments.jobs,arguments.approximate,
+            arguments.chunksize if arguments.stream else None) for path in paths]
+
+    if export_jobs == 1 or len(tasks) < 2:
+        results=[_ExportWorker(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(export_jobs,len(tasks))) as pool:
+            results=list(pool.map(_ExportWorker,tasks))
+
+    for written in results:
+        for path in written:
+            print(path)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Main())
@@ -0,0 +1,54 @@
+import concurrent.futures
+import os
+import pandas as pd
+
+import pipeline
+
+
+def _SegmentWorker(arguments):
+    '''
+    Computes the tidy metric set of one segment, in a worker process.
+    '''
+    segment,order,granularity,approximate=arguments
+    return segment,pipeline.TidyMetrics(pipeline.Metrics(order,granularity,approximate))
+
+
+def Partitions(order,segment_column):
+    '''
+    Returns (segment value, completed orders) for every value of segment_column.
+    Orders without a value are left out.
+    '''
+    return [(segment,partition) for segment,partition in order.groupby(segment_column,sort=True)
+            if partition.shape[0] > 0]
+
+
+def SegmentMetrics(order,segment_column,granularity='Month',jobs=None,approximate=False):
+    '''
+    Returns the full metric set (users, lifetime, values and cohort tables) of every value
+    of segment_column, as one tidy dataframe with a segment column in front of the
+    columns of pipeline.TidyMetrics.
+    Segments are computed in a pool of jobs processes, one per core by default.
+    With approximate, distinct users are counted with sketches (see pipeline.ApproximateMetrics).
+    '''
+    if jobs is None:
+        jobs=os.cpu_count() or 1
+
+    tasks=[(segment,partition,granularity,approximate) for segment,partition in Partitions(order,segment_column)]
+
+    if jobs == 1 or len(tasks) < 2:
+        results=[_SegmentWorker(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs,len(tasks))) as pool:
+            results=list(pool.map(_SegmentWorker,tasks))
+
+    tidy_results=[]
+    for segment,tidy in results:
+        tidy.insert(0,'segment',segment)
+        tidy_results.append(tidy)
+
+    if not tidy_results:
+        return pd.DataFrame(columns=['segment','metric','period','offset','value'])
+
+    combined=pd.concat(tidy_results,ignore_index=True)
+    combined.insert(0,'segment_column',segment_column)
+    return combined
@@ -0,0 +1,208 @@
+import numpy as np
+import pandas as pd
+
+import loader
+import methods
+import periods
+import pipeline
+
+##############################
+# Metrics computed inside the database that holds the orders.
+# Only the per-month sums and the cohort crosstab come back, never the orders.
+# Any DB-API connection works; the month of an order is an SQL expression
+# since every database spells it differently. It must give the month code of periods.PeriodCodes,
+# the number of months since 1970-01.
+##############################
+
+SQLITE_MONTH_CODE = "(CAST(strftime('%Y',completed_at) AS INTEGER) - 1970)*12 + CAST(strftime('%m',completed_at) AS INTEGER) - 1"
+
+POSTGRES_MONTH_CODE = "(CAST(EXTRACT(YEAR FROM completed_at) AS INTEGER) - 1970)*12 + CAST(EXTRACT(MONTH FROM completed_at) AS INTEGER) - 1"
+
+DEFAULT_TABLE = 'orders'
+
+DEFAULT_START_YEAR = 2018
+
+# completed orders since the start year, with their month code
+COMPLETED_SQL = '''
+completed AS (
+    SELECT user_id, total, item_total, {month_code} AS month
+    FROM {table}
+    WHERE state = 'complete' AND completed_at IS NOT NULL
+),
+recent AS (
+    SELECT user_id, total, item_total, month FROM completed WHERE month >= {start_month}
+),
+activity AS (
+    SELECT DISTINCT user_id, month FROM recent WHERE user_id IS NOT NULL
+),
+first_months AS (
+    SELECT user_id, MIN(month) AS first_month FROM activity GROUP BY user_id
+)
+'''
+
+MONTH_SUMS_SQL = '''
+SELECT month, COUNT(*), SUM(total), SUM(item_total)
+FROM recent
+GROUP BY month
+ORDER BY month
+'''
+
+# users, orders and revenue of every cohort and month in one grouped pass
+COHORT_SQL = '''
+SELECT first_months.first_month, recent.month, COUNT(DISTINCT recent.user_id), COUNT(*), SUM(recent.total)
+FROM recent JOIN first_months ON recent.user_id = first_months.user_id
+GROUP BY first_months.first_month, recent.month
+'''
+
+# every user active in a month counts the months in which it was active so far
+LIFETIME_SQL = '''
+SELECT activity.month, COUNT(*)
+FROM activity JOIN activity AS earlier
+    ON activity.user_id = earlier.user_id AND earlier.month <= activity.month
+GROUP BY activity.month
+'''
+
+
+def LoadSqlite(connection,paths,table=DEFAULT_TABLE,columns=loader.DEFAULT_COLUMNS):
+    '''
+    Loads the orders of the exports at paths into table, replacing it.
+    Orders found in several exports are kept once, in their latest version (updated_at),
+    as in order_store.OrderStore.
+    Timestamps are stored as text, which SQLite date functions understand.
+    '''
+    if 'updated_at' not in columns:
+        columns=list(columns) + ['updated_at']
+    orders=pd.concat([loader.ReadOrdersCsv(path,columns) for path in paths],ignore_index=True)
+    orders=orders.sort_values('updated_at',kind='mergesort').drop_duplicates('id',keep='last')
+
+    for column in loader.DATE_COLUMNS:
+        if column in orders.columns:
+            text=orders[column].dt.strftime('%Y-%m-%d %H:%M:%S.%f').astype(object)
+            orders[column]=text.where(orders[column].notnull(),None)
+    for column in orders.columns:
+        if isinstance(orders[column].dtype,pd.CategoricalDtype):
+            orders[column]=orders[column].astype(object)
+
+    orders.to_sql(table,connection,if_exists='replace',index=False)
+    connection.cursor().execute('CREATE INDEX IF NOT EXISTS {0}_state ON {0} (state)'.format(table))
+    connection.commit()
+
+
+class SqlBackend(object):
+    '''
+    Dashboard metrics of the orders of a database table, aggregated by the database.
+    Users without an id (guest orders) count in the order sums but not as users.
+    '''
+
+    def __init__(self,connection,table=DEFAULT_TABLE,month_code=SQLITE_MONTH_CODE,start_year=DEFAULT_START_YEAR):
+        self.connection=connection
+        self.table=table
+        self.month_code=month_code
+        self.start_year=start_year
+
+    def _Query(self,sql):
+        completed=COMPLETED_SQL.format(month_code=self.month_code,table=self.table,start_month=periods.MonthCode(1,int(self.start_year)))
+        cursor=self.connection.cursor()
+        try:
+            cursor.execute('WITH '+completed+sql)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def MonthSums(self):
+        '''
+        Returns every month from the first to the last with a completed order, as month codes,
+        with their number of orders and sums of total and item_total (0 for months without orders).
+        '''
+        rows=self._Query(MONTH_SUMS_SQL)
+        month_sums=pd.DataFrame(rows,columns=['month','orders','total','item_total'])
+        month_sums=month_sums.astype({'month':'int64','orders':'int64','total':float,'item_total':float})
+        if month_sums.shape[0] == 0:
+            return month_sums
+
+        # months without orders are kept, like the dense periods of pipeline.PeriodMetrics
+        codes=pd.Index(np.arange(month_sums['month'].min(),month_sums['month'].max()+1),name='month')
+        return month_sums.set_index('month').reindex(codes,fill_value=0).reset_index()
+
+    def Months(self,month_sums=None):
+        '''
+        Returns the months from the first to the last with a completed order, sorted, as (month, year).
+        '''
+        if month_sums is None:
+            month_sums=self.MonthSums()
+        return [periods.MonthYear(code) for code in month_sums['month']]
+
+    def _Positions(self,month_codes,month_sums):
+        return np.searchsorted(month_sums['month'].values,np.asarray(month_codes,dtype='int64'))
+
+    def CohortMatrices(self,month_sums=None):
+        '''
+        Returns the user, order count and revenue cohort matrices laid out like methods.CohortMatrices.
+        '''
+        if month_sums is None:
+            month_sums=self.MonthSums()
+        num_months=month_sums.shape[0]
+
+        rows=pd.DataFrame(self._Query(COHORT_SQL),columns=['first_month','month','users','orders','revenue'])
+        first_month=self._Positions(rows['first_month'],month_sums)
+        cells=first_month*num_months + self._Positions(rows['month'],month_sums) - first_month
+
+        matrices=[]
+        for column,dtype in [('users','int64'),('orders','int64'),('revenue',float)]:
+            matrix=np.zeros(num_months*num_months,dtype=dtype)
+            matrix[cells]=rows[column].values.astype(dtype)
+            matrices.append(matrix.reshape(num_months,num_months))
+        return tuple(matrices)
+
+    def CohortCounts(self,month_sums=None):
+        '''
+        Returns the user cohort matrix laid out like methods.CohortCounts.
+        '''
+        return self.CohortMatrices(month_sums)[0]
+
+    def CustomerLifetime(self,total_users,month_sums=None):
+        '''
+        Returns the customer lifetime of every month, as methods.CustomerLifetimePerMonth.
+        '''
+        if month_sums is None:
+            month_sums=self.MonthSums()
+
+        rows=np.array(self._Query(LIFETIME_SQL),dtype='int64').reshape(-1,2)
+        lifetime_sum=np.zeros(month_sums.shape[0])
+        lifetime_sum[self._Positions(rows[:,0],month_sums)]=rows[:,1]
+        # months without users have no lifetime
+        with np.errstate(divide='ignore',invalid='ignore'):
+            return lifetime_sum / total_users
+
+    def Metrics(self):
+        '''
+        Returns the dashboard series and cohort tables, laid out like pipeline.MonthlyMetrics.
+        '''
+        month_sums=self.MonthSums()
+        months=self.Months(month_sums)
+        counts,orders,revenue=self.CohortMatrices(month_sums)
+
+        # the users active in a month are spread over the cohorts of that month and the earlier ones
+        num_months=len(months)
+        first_month,offset=np.divmod(np.arange(num_months*num_months),num_months)
+        in_range=first_month + offset < num_months
+        total_users=np.bincount((first_month + offset)[in_range],weights=counts.ravel()[in_range],minlength=num_months).astype('int64')
+        new_users=counts[:,0]
+
+        customers_lifetime=self.CustomerLifetime(total_users,month_sums)
+
+        cumulative=month_sums[['orders','total','item_total']].cumsum()
+        basket_value=cumulative['item_total'] / cumulative['orders']
+        avg_order_value=cumulative['total'] / cumulative['orders']
+
+        metrics={
+            'period_names':['{:02d}/{}'.format(month[0],month[1]) for month in months],
+            'total_users':total_users.tolist(),
+            'new_users':new_users.tolist(),
+            'repeating_users':(total_users - new_users).tolist(),
+            'customers_lifetime':customers_lifetime.tolist(),
+            'basket_value':basket_value.tolist(),
+            'customers_lifetime_value':(customers_lifetime * avg_order_value.values).tolist(),
+        }
+        metrics.update(zip(pipeline.COHORT_TABLES,methods.CohortTablesFromMatrices(months,counts,orders,revenue)))
+        return metrics
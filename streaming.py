@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+
+import loader
+import methods
+import periods
+import pipeline
+
+# columns read from the export, everything else (email, guest_token, ...) is never parsed
+STREAM_COLUMNS = ['user_id','state','completed_at','total','item_total']
+
+DEFAULT_CHUNKSIZE = 100000
+
+
+class StreamingAggregates(object):
+    '''
+    Aggregates of the completed orders of an export, folded chunk by chunk.
+    Only the per-month order aggregates and the orders and total of every (user, month) pair are kept,
+    so memory depends on the chunk size and on the number of users and months,
+    not on the number of orders.
+    Months are stored as their periods.PeriodCodes code.
+    Folded (user, month) pairs are merged once they are more than chunksize and than the merged ones.
+    '''
+
+    def __init__(self,start_year=None,chunksize=DEFAULT_CHUNKSIZE):
+        self.start_year=start_year
+        self.chunksize=chunksize
+        self.month_totals=pd.DataFrame(columns=['orders','total','item_total'],dtype=float)
+
+        self.activity=pd.DataFrame({'user_id':np.array([],dtype=float),'month':np.array([],dtype=np.int64),
+                                    'orders':np.array([],dtype=np.int64),'total':np.array([],dtype=float)})
+        self.pending=[]
+        self.pending_rows=0
+
+        self.rows=0
+        self.completed_rows=0
+
+    def Fold(self,chunk):
+        '''
+        Adds the completed orders of a chunk of the export.
+        '''
+        self.rows+=chunk.shape[0]
+
+        chunk=chunk[chunk.state=='complete']
+        completed_at=loader.ParseDates(chunk['completed_at'])
+        if self.start_year is not None:
+            recent=(completed_at.dt.year >= self.start_year).values
+            chunk=chunk[recent]
+            completed_at=completed_at[recent]
+        self.completed_rows+=chunk.shape[0]
+
+        months=periods.PeriodCodes(completed_at,'Month')
+        month_groups=chunk.groupby(months)
+        totals=pd.DataFrame({
+            'orders':month_groups.size(),
+            'total':month_groups['total'].sum(),
+            'item_total':month_groups['item_total'].sum(),
+        })
+        self.month_totals=self.month_totals.add(totals,fill_value=0)
+
+        pairs=pd.DataFrame({'user_id':chunk['user_id'].values.astype(float),'month':months,'total':chunk['total'].values})
+        pairs=pairs.groupby(['user_id','month'],as_index=False).agg(orders=('total','size'),total=('total','sum'))
+        self.pending.append(pairs)
+        self.pending_rows+=pairs.shape[0]
+
+        # merge once the pending pairs are as many as the known ones, so the cost stays linear
+        if self.pending_rows > max(self.activity.shape[0],self.chunksize):
+            self._Merge()
+
+    def _Merge(self):
+        if self.pending:
+            activity=pd.concat([self.activity] + self.pending,ignore_index=True)
+            self.activity=activity.groupby(['user_id','month'],as_index=False)[['orders','total']].sum()
+            self.pending=[]
+            self.pending_rows=0
+
+    def _MonthCodes(self):
+        # every month from the first to the last with a completed order, like pipeline.PeriodMetrics
+        if self.month_totals.shape[0] == 0:
+            return np.array([],dtype=np.int64)
+        codes=self.month_totals.index.values.astype(np.int64)
+        return np.arange(codes.min(),codes.max()+1)
+
+    def Months(self):
+        '''
+        Returns the months from the first to the last with a completed order, sorted, as (month, year).
+        '''
+        return [periods.MonthYear(code) for code in self._MonthCodes()]
+
+    def UserActivity(self):
+        '''
+        Returns, for every user, the first and last month with a completed order
+        and the number of months with a completed order.
+        '''
+        self._Merge()
+        user_months=self.activity.groupby('user_id')['month']
+        return pd.DataFrame({
+            'first_month':user_months.min(),
+            'last_month':user_months.max(),
+            'active_months':user_months.size(),
+        })
+
+    def Metrics(self):
+        '''
+        Returns the dashboard series and cohort tables, laid out like pipeline.MonthlyMetrics.
+        '''
+        self._Merge()
+        month_codes=self._MonthCodes()
+        num_months=month_codes.shape[0]
+        months=self.Months()
+
+        user_ids=self.activity['user_id'].values
+        positions=np.searchsorted(month_codes,self.activity['month'].values)
+
+        total_users,new_users,repeating_users=methods.PeriodUsers(user_ids,positions,num_months)
+        customers_lifetime=methods.PeriodLifetime(user_ids,positions,num_months)
+
+        month_totals=self.month_totals.reindex(month_codes,fill_value=0).cumsum()
+        basket_value=month_totals['item_total'] / month_totals['orders']
+        avg_order_value=month_totals['total'] / month_totals['orders']
+
+        users,orders,revenue=methods.PeriodCohortMatrices(user_ids,positions,self.activity['total'].values,num_months,
+                                                          self.activity['orders'].values)
+
+        metrics={
+            'period_names':['{:02d}/{}'.format(month[0],month[1]) for month in months],
+            'total_users':total_users.tolist(),
+            'new_users':new_users.tolist(),
+            'repeating_users':repeating_users.tolist(),
+            'customers_lifetime':customers_lifetime.tolist(),
+            'basket_value':basket_value.tolist(),
+            'customers_lifetime_value':(customers_lifetime * avg_order_value.values).tolist(),
+        }
+        metrics.update(zip(pipeline.COHORT_TABLES,methods.CohortTablesFromMatrices(months,users,orders,revenue)))
+        return metrics
+
+
+def StreamOrders(path,chunksize=DEFAULT_CHUNKSIZE,start_year=None):
+    '''
+    Reads an export chunksize rows at a time, keeping only the completed orders,
+    and returns their StreamingAggregates.
+    '''
+    aggregates=StreamingAggregates(start_year,chunksize)
+
+    wanted=set(STREAM_COLUMNS)
+    chunks=pd.read_csv(path,
+                       usecols=lambda column: column in wanted,
+                       dtype={column:dtype for column,dtype in loader.ORDER_DTYPES.items() if column in wanted},
+                       chunksize=chunksize)
+    for chunk in chunks:
+        aggregates.Fold(chunk)
+
+    return aggregates
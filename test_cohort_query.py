@@ -0,0 +1,44 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+
+import cohort_query
+import loader
+import pipeline
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+EXPORTS = sorted(glob.glob(os.path.join(DIRECTORY,'query_result_*.csv')))
+
+
+def CompletedOrders():
+    order=loader.ReadOrdersCsv(EXPORTS[-1])
+    return order[(order.state=='complete') & (order.completed_at.dt.year>=2018)]
+
+
+@pytest.mark.skipif(not EXPORTS,reason='no bundled export')
+def test_members_match_the_cohort_counts():
+    order=CompletedOrders()
+    index=cohort_query.CohortIndex.FromOrders(order)
+    abs_cohort_df=pipeline.Metrics(order)['abs_cohort_df']
+
+    counts=abs_cohort_df.iloc[:-1,1:].values.astype(float)
+    for cohort in range(counts.shape[0]):
+        for offset in range(counts.shape[1]):
+            if np.isnan(counts[cohort,offset]):
+                continue
+            active_in=[cohort + offset] if offset else []
+            assert len(index.Members(cohort,active_in).Users()) == counts[cohort,offset],(cohort,offset)
+
+
+@pytest.mark.skipif(not EXPORTS,reason='no bundled export')
+def test_april_users_repeated_in_may():
+    with open(os.path.join(DIRECTORY,'april_users_repeated_in_may.txt')) as users_file:
+        expected=sorted(int(line) for line in users_file if line.strip())
+
+    index=cohort_query.CohortIndex.FromOrders(CompletedOrders())
+    members=index.Members('04/2018',['05/2018'])
+    assert members.Users().tolist() == expected
+    assert cohort_query.MembersCsv(members).split() == ['user_id'] + [str(user) for user in expected]
@@ -0,0 +1,74 @@
+import sqlite3
+
+import numpy as np
+
+import metric_state
+import pipeline
+import sql_backend
+import streaming
+from test_methods import Orders
+
+# no order in February and April
+GAP_ORDERS = Orders([
+    (1,'2018-01-03',10.0),
+    (2,'2018-01-09',20.0),
+    (None,'2018-01-15',30.0),
+    (1,'2018-03-02',40.0),
+    (3,'2018-03-21',60.0),
+    (2,'2018-05-02',15.0),
+    (3,'2018-05-11',25.0),
+])
+
+
+def AssertSameMetrics(metrics,expected):
+    assert metrics['period_names'] == expected['period_names']
+    for metric in pipeline.SERIES:
+        np.testing.assert_allclose(metrics[metric],expected[metric],rtol=1e-12,err_msg=metric)
+    for table in pipeline.COHORT_TABLES:
+        assert list(metrics[table].columns) == list(expected[table].columns),table
+        assert metrics[table].iloc[:,0].tolist() == expected[table].iloc[:,0].tolist(),table
+        np.testing.assert_allclose(metrics[table].iloc[:,1:].values.astype(float),
+                                   expected[table].iloc[:,1:].values.astype(float),rtol=1e-12,err_msg=table)
+
+
+def StateMetrics(order):
+    state=metric_state.MetricState()
+    # folded in two updates, the gap of April is crossed by the second one
+    state.Update(order[order.completed_at.dt.month < 4])
+    state.Update(order)
+
+    monthly_table=state.MonthlyTable()
+    metrics={'period_names':['{:02d}/{}'.format(month[0],month[1]) for month in state.Months()]}
+    for metric in pipeline.SERIES:
+        metrics[metric]=monthly_table[metric].tolist()
+    metrics.update(zip(pipeline.COHORT_TABLES,state.CohortTables()))
+    return metrics
+
+
+def StreamingMetrics(order,chunksize=2):
+    # chunks small enough for the folded pairs to be merged on the way
+    aggregates=streaming.StreamingAggregates(chunksize=chunksize)
+    export=order.copy()
+    export['completed_at']=export['completed_at'].dt.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    for start in range(0,export.shape[0],chunksize):
+        aggregates.Fold(export.iloc[start:start+chunksize])
+    return aggregates.Metrics()
+
+
+def SqlMetrics(order):
+    connection=sqlite3.connect(':memory:')
+    table=order.copy()
+    table['completed_at']=table['completed_at'].dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+    table.to_sql(sql_backend.DEFAULT_TABLE,connection,index=False)
+    return sql_backend.SqlBackend(connection).Metrics()
+
+
+def test_engines_agree_on_months_without_orders():
+    expected=pipeline.Metrics(GAP_ORDERS)
+    assert expected['period_names'] == ['01/2018','02/2018','03/2018','04/2018','05/2018']
+    assert expected['abs_cohort_df']['NC'].tolist() == [2,0,1,0,0]
+    # user 1 of the January cohort comes back two months later
+    assert expected['abs_cohort_df']['Month 2'].tolist()[0] == 1
+
+    for metrics in [StateMetrics(GAP_ORDERS),StreamingMetrics(GAP_ORDERS),SqlMetrics(GAP_ORDERS)]:
+        AssertSameMetrics(metrics,expected)
@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+import benchmark
+import hyperloglog
+import methods
+import metric_state
+import pipeline
+
+
+def Orders(rows):
+    '''
+    Returns completed orders from (user_id, completed_at, total) rows.
+    '''
+    order=pd.DataFrame(rows,columns=['user_id','completed_at','total'])
+    order['user_id']=order['user_id'].astype('float64')
+    order['completed_at']=pd.to_datetime(order['completed_at'])
+    order['item_total']=order['total']
+    order['state']='complete'
+    return order
+
+
+# a guest order (no user_id) in every month
+GUEST_ORDERS = Orders([
+    (1,'2018-01-03',10.0),
+    (2,'2018-01-09',20.0),
+    (None,'2018-01-15',30.0),
+    (1,'2018-02-02',40.0),
+    (None,'2018-02-20',50.0),
+    (3,'2018-02-21',60.0),
+])
+
+
+def test_guest_orders_are_not_users():
+    user_ids=GUEST_ORDERS['user_id'].values
+    positions=np.array([0,0,0,1,1,1])
+
+    total_users,new_users,repeating_users=methods.PeriodUsers(user_ids,positions,2)
+    assert total_users.tolist() == [2,2]
+    assert new_users.tolist() == [2,1]
+    assert repeating_users.tolist() == [0,1]
+    assert methods.PeriodLifetime(user_ids,positions,2).tolist() == [1.0,1.5]
+
+    users,orders,revenue=methods.PeriodCohortMatrices(user_ids,positions,GUEST_ORDERS['total'].values,2)
+    assert users.tolist() == [[2,1],[1,0]]
+    assert orders.tolist() == [[2,1],[1,0]]
+    assert revenue.tolist() == [[30.0,40.0],[60.0,0.0]]
+    assert methods.PeriodCohortCounts(user_ids,positions,2).tolist() == [[2,1],[1,0]]
+
+    renewal_users=methods.PeriodRenewalUsers(user_ids,positions,np.zeros(6,dtype=bool),2)
+    assert [values.tolist() for values in renewal_users] == [[2,2],[2,1],[0,1],[0,1],[0,0]]
+
+    sketches=hyperloglog.PeriodRegisters(user_ids,positions,2)
+    assert np.rint(hyperloglog.Estimate(sketches)).tolist() == [2.0,2.0]
+
+
+def test_guest_orders_in_metrics():
+    metrics=pipeline.Metrics(GUEST_ORDERS)
+    assert metrics['total_users'] == [2,2]
+    assert metrics['new_users'] == [2,1]
+    # guest orders still count in the order values
+    assert metrics['basket_value'] == [20.0,35.0]
+
+    state=metric_state.MetricState()
+    state.Update(GUEST_ORDERS)
+    monthly_table=state.MonthlyTable()
+    assert monthly_table['total_users'].tolist() == metrics['total_users']
+    assert monthly_table['new_users'].tolist() == metrics['new_users']
+    for state_table,table in zip(state.CohortTables(),pipeline.COHORT_TABLES):
+        assert state_table.values.tolist() == metrics[table].values.tolist()
+
+
+def SubscriptionOrders():
+    # user 1 renews twice, user 2 never renews, user 3 renews once and user 4 has no subscription
+    order=Orders([
+        (1,'2018-01-05',10.0),
+        (2,'2018-01-06',10.0),
+        (4,'2018-01-07',10.0),
+        (1,'2018-02-05',10.0),
+        (3,'2018-02-06',10.0),
+        (1,'2018-03-05',10.0),
+        (3,'2018-03-06',10.0),
+    ])
+    order['is_renewal']=[False,False,False,True,False,True,True]
+    order['recurring_count']=[1.0,1.0,0.0,0.0,1.0,0.0,0.0]
+    return order
+
+
+def test_subscriber_without_renewal():
+    survival_df=pipeline.Metrics(SubscriptionOrders())['survival_df']
+    assert survival_df.values.tolist() == [
+        ['1-2018',2,0.5,0.5],
+        ['2-2018',1,1.0,0.0],
+        ['All',3,2/3,1/3],
+    ]
+
+
+def test_survival_without_subscription_columns():
+    order=SubscriptionOrders().drop(columns=['is_renewal','recurring_count'])
+    metrics=pipeline.Metrics(order)
+    assert metrics['survival_df'].empty
+    assert list(metrics['survival_df'].columns) == ['Month','Subscribers']
+    assert metrics['renewal_users'] == [0,0,0]
+    assert metrics['organic_repeating_users'] == metrics['repeating_users']
+
+
+def BaselineRows(dataframe):
+    '''
+    Returns the (value, style) of every cell as the original cell by cell ConditionalTable styled them.
+    '''
+    rows=[]
+    for i in range(len(dataframe)):
+        row=dataframe.iloc[i]
+        last_row = i == len(dataframe)-1
+        if not last_row:
+            max_value=np.nanmax(row.values[2:].astype(float))
+            min_value=np.nanmin(row.values[2:].astype(float))
+
+        cells={}
+        for col_index,col in enumerate(dataframe.columns):
+            value=row[col]
+            if not last_row and col_index > 1:
+                style=methods.cell_style(value,min_value,max_value)
+            else:
+                style=methods.cell_style(value,0.0,0.0)
+            if not last_row and isinstance(value,float) and ~np.isnan(value):
+                value='{:.3f}'.format(value)
+            cells[col]=(value,dict(methods.CELL_STYLE,**style))
+        rows.append(cells)
+    return rows
+
+
+def test_conditional_table_matches_the_cell_by_cell_styles():
+    order=benchmark.SyntheticOrders(300,num_months=8)
+    metrics=pipeline.Metrics(order[order.state=='complete'])
+    for table in pipeline.COHORT_TABLES:
+        expected=BaselineRows(metrics[table])
+        rows=methods.ConditionalTable(metrics[table])
+        # pages are styled like the whole table
+        paged=[row for start in range(0,len(metrics[table]),3) for row in methods.ConditionalTable(metrics[table],start,start+3)]
+
+        for styled_rows in [rows,paged]:
+            cells=[{col:(div.children,div.style) for col,div in row.items()} for row in styled_rows]
+            assert len(cells) == len(expected)
+            for row,expected_row in zip(cells,expected):
+                for col,(value,style) in expected_row.items():
+                    assert row[col][1] == style,(table,col)
+                    if isinstance(value,float) and np.isnan(value):
+                        assert np.isnan(row[col][0])
+                    else:
+                        assert row[col][0] == value,(table,col)
@@ -0,0 +1,23 @@
+import os
+
+import metric_state
+from test_methods import GUEST_ORDERS
+
+
+def test_state_is_rebuilt_when_an_export_changes(tmp_path):
+    path=str(tmp_path / 'metric_state.pkl')
+    sources=[('query_result_1.csv',100,1)]
+
+    state=metric_state.LoadMetricState(path,sources)
+    state.Update(GUEST_ORDERS.iloc[:3],sources)
+    state.Save(path)
+
+    # a new export keeps the folded months
+    grown=sources + [('query_result_2.csv',200,2)]
+    assert metric_state.LoadMetricState(path,grown).Months() == [(1,2018)]
+
+    # a modified or removed export starts over
+    assert metric_state.LoadMetricState(path,[('query_result_1.csv',120,3)]).Months() == []
+    assert metric_state.LoadMetricState(path,[('query_result_2.csv',200,2)]).Months() == []
+
+    assert os.listdir(str(tmp_path)) == ['metric_state.pkl']
@@ -0,0 +1,62 @@
+import multiprocessing
+
+import pandas as pd
+
+import order_store
+
+COLUMNS = ['id','user_id','state','completed_at','updated_at','total','item_total']
+
+
+def WriteExport(path,rows,**columns):
+    export=pd.DataFrame(rows,columns=COLUMNS)
+    for column,values in columns.items():
+        export[column]=values
+    export.to_csv(str(path),index=False)
+    return str(path)
+
+
+def test_ingest_keeps_the_latest_version(tmp_path):
+    first=WriteExport(tmp_path / 'query_result_1.csv',[
+        [1,7,'complete','2018-01-02T10:00:00.000Z','2018-01-02T10:00:00.000Z',10.0,10.0],
+        [2,8,'complete','2018-01-03T10:00:00.000Z','2018-01-03T10:00:00.000Z',20.0,20.0],
+    ],is_renewal=[False,True],recurring_count=[1.0,0.0])
+    # order 1 changed, order 2 unchanged and order 3 new; no subscription columns
+    second=WriteExport(tmp_path / 'query_result_2.csv',[
+        [1,7,'complete','2018-01-02T10:00:00.000Z','2018-02-01T10:00:00.000Z',30.0,30.0],
+        [2,8,'complete','2018-01-03T10:00:00.000Z','2018-01-03T10:00:00.000Z',20.0,20.0],
+        [3,9,'complete','2018-02-04T10:00:00.000Z','2018-02-04T10:00:00.000Z',40.0,40.0],
+    ])
+
+    store=order_store.OrderStore(str(tmp_path / 'order_store'))
+    assert store.Ingest(first) == 2
+    assert store.Ingest(second) == 2
+    # an export that was already ingested is skipped
+    assert store.Ingest(first) == 0
+    assert order_store.OrderStore(str(tmp_path / 'order_store')).Ingest(second) == 0
+
+    order=store.Orders()
+    assert list(order.columns) == order_store.STORE_COLUMNS
+    assert order['id'].tolist() == [1,2,3]
+    assert order['total'].tolist() == [30.0,20.0,40.0]
+    # the columns missing from the second export are empty, not dropped
+    assert order['is_renewal'].isna().tolist() == [True,False,True]
+    assert bool(order['is_renewal'][1])
+
+
+def _Ingest(arguments):
+    store_dir,path=arguments
+    return order_store.OrderStore(store_dir).Ingest(path)
+
+
+def test_concurrent_ingests_keep_every_export(tmp_path):
+    paths=[WriteExport(tmp_path / 'query_result_{}.csv'.format(index),
+                       [[index,index,'complete','2018-01-02T10:00:00.000Z','2018-01-02T10:00:00.000Z',10.0,10.0]])
+           for index in range(1,9)]
+    store_dir=str(tmp_path / 'order_store')
+
+    with multiprocessing.Pool(4) as pool:
+        assert pool.map(_Ingest,[(store_dir,path) for path in paths]) == [1]*8
+
+    store=order_store.OrderStore(store_dir)
+    assert len(store.manifest['exports']) == 8
+    assert store.Orders()['id'].tolist() == list(range(1,9))
@@ -0,0 +1,51 @@
+import glob
+import json
+import os
+
+import numpy as np
+import pytest
+
+import report
+import streaming
+
+EXPORTS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),'query_result_*.csv')))
+
+
+@pytest.mark.skipif(not EXPORTS,reason='no bundled export')
+def test_streamed_report_matches_loaded_report(tmp_path,monkeypatch):
+    merges=[]
+    merge=streaming.StreamingAggregates._Merge
+
+    def CountingMerge(aggregates):
+        merges.append(len(aggregates.pending))
+        merge(aggregates)
+
+    monkeypatch.setattr(streaming.StreamingAggregates,'_Merge',CountingMerge)
+
+    export=EXPORTS[-1]
+    assert report.Main([export,'--output-dir',str(tmp_path / 'loaded'),'--no-cache']) == 0
+    assert report.Main([export,'--output-dir',str(tmp_path / 'streamed'),'--stream','--chunksize','200']) == 0
+    # the pairs of several chunks were merged before the end of the export
+    assert any(pending > 1 for pending in merges[:-1])
+
+    name=os.path.splitext(os.path.basename(export))[0]+'.json'
+    with open(str(tmp_path / 'loaded' / name)) as loaded_file:
+        loaded=json.load(loaded_file)
+    with open(str(tmp_path / 'streamed' / name)) as streamed_file:
+        streamed=json.load(streamed_file)
+
+    assert streamed['period_names'] == loaded['period_names']
+    for metric in report.pipeline.SERIES:
+        np.testing.assert_allclose(streamed[metric],loaded[metric],rtol=1e-12,err_msg=metric)
+    for table in report.pipeline.COHORT_TABLES:
+        assert streamed[table[:-3]]['columns'] == loaded[table[:-3]]['columns']
+        streamed_cells=np.array(streamed[table[:-3]]['data'],dtype=object)
+        loaded_cells=np.array(loaded[table[:-3]]['data'],dtype=object)
+        assert streamed_cells[:,0].tolist() == loaded_cells[:,0].tolist()
+        np.testing.assert_allclose(streamed_cells[:,1:].astype(float),loaded_cells[:,1:].astype(float),rtol=1e-12,err_msg=table)
+
+
+def test_stream_rejects_other_granularities(capsys):
+    with pytest.raises(SystemExit):
+        report.Main(['--stream','--granularity','Week'])
+    assert '--stream' in capsys.readouterr().err
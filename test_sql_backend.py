@@ -0,0 +1,41 @@
+import glob
+import os
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import order_store
+import pipeline
+import sql_backend
+from test_engines import AssertSameMetrics
+
+EXPORTS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),'query_result_*.csv')))
+
+
+@pytest.mark.skipif(not EXPORTS,reason='no bundled export')
+def test_sqlite_metrics_match_pandas(tmp_path):
+    connection=sqlite3.connect(':memory:')
+    sql_backend.LoadSqlite(connection,EXPORTS)
+
+    # the order store keeps the latest version of every order, like LoadSqlite
+    store=order_store.OrderStore(str(tmp_path / 'order_store'))
+    for path in EXPORTS:
+        store.Ingest(path)
+    order=store.Orders()
+    order=order[(order.state=='complete') & (order.completed_at.dt.year>=sql_backend.DEFAULT_START_YEAR)]
+
+    AssertSameMetrics(sql_backend.SqlBackend(connection).Metrics(),pipeline.Metrics(order))
+
+
+def test_load_sqlite_keeps_the_latest_version(tmp_path):
+    columns=['id','user_id','state','completed_at','updated_at','total','item_total']
+    newer=pd.DataFrame([[1,7,'complete','2018-01-02T10:00:00.000Z','2018-02-01T10:00:00.000Z',30.0,30.0]],columns=columns)
+    older=pd.DataFrame([[1,7,'complete','2018-01-02T10:00:00.000Z','2018-01-02T10:00:00.000Z',10.0,10.0]],columns=columns)
+    # the export listed last holds the older version
+    newer.to_csv(str(tmp_path / 'a.csv'),index=False)
+    older.to_csv(str(tmp_path / 'b.csv'),index=False)
+
+    connection=sqlite3.connect(':memory:')
+    sql_backend.LoadSqlite(connection,[str(tmp_path / 'a.csv'),str(tmp_path / 'b.csv')])
+    assert connection.execute('SELECT id, total FROM orders').fetchall() == [(1,30.0)]
@@ -0,0 +1,85 @@
+import numpy as np
+
+# number of set bits of every byte
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)],dtype=np.uint8)
+
+
+class UserSet(object):
+    '''
+    Set of users stored as a bitmap over a universe of user ids.
+    The universe is the sorted array of all the known user ids: user universe[i] is bit i.
+    Sets over the same universe are combined with | (union), & (intersection)
+    and - (difference) without sorting or allocating more than one bitmap.
+    '''
+
+    def __init__(self,universe,bits):
+        self.universe=universe
+        self.bits=bits
+
+    @classmethod
+    def Empty(cls,universe):
+        return cls(universe,np.zeros((universe.shape[0] + 7) // 8,dtype=np.uint8))
+
+    @classmethod
+    def FromCodes(cls,universe,codes):
+        '''
+        Returns the set of the users at positions codes of universe.
+        '''
+        user_set=cls.Empty(universe)
+        codes=np.asarray(codes,dtype=np.int64)
+        np.bitwise_or.at(user_set.bits,codes >> 3,(0x80 >> (codes & 7)).astype(np.uint8))
+        return user_set
+
+    @classmethod
+    def FromUsers(cls,universe,user_ids):
+        '''
+        Returns the set of user_ids, which must all belong to universe.
+        '''
+        return cls.FromCodes(universe,np.searchsorted(universe,user_ids))
+
+    def _Check(self,other):
+        if self.universe is not other.universe and not np.array_equal(self.universe,other.universe):
+            raise ValueError('user sets over different universes can not be combined')
+
+    def __or__(self,other):
+        self._Check(other)
+        return UserSet(self.universe,self.bits | other.bits)
+
+    def __and__(self,other):
+        self._Check(other)
+        return UserSet(self.universe,self.bits & other.bits)
+
+    def __sub__(self,other):
+        self._Check(other)
+        return UserSet(self.universe,self.bits & ~other.bits)
+
+    def __len__(self):
+        return int(POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def __contains__(self,user):
+        code=np.searchsorted(self.universe,user)
+        if code == self.universe.shape[0] or self.universe[code] != user:
+            return False
+        return bool(self.bits[code >> 3] & (0x80 >> (code & 7)))
+
+    def Codes(self):
+        '''
+        Returns the sorted positions in universe of the users of the set.
+        '''
+        return np.flatnonzero(np.unpackbits(self.bits)[:self.universe.shape[0]])
+
+    def Users(self):
+        '''
+        Returns the sorted user ids of the set, as np.intersect1d / np.setdiff1d would.
+        '''
+        return self.universe[self.Codes()]
+
+
+def Union(user_sets,universe):
+    '''
+    Returns the union of user_sets, all over universe.
+    '''
+    union=UserSet.Empty(universe)
+    for user_set in user_sets:
+        np.bitwise_or(union.bits,user_set.bits,out=union.bits)
+    return union